@@ -51,6 +51,108 @@ MEDIA_ROOT = '/var/www/upload/'
 # Examples: "http://example.com/media/", "http://media.example.com/"
 MEDIA_URL = ''
 
+# Directory that submission uploads are spooled to before they are moved into
+# place. Keep this on the same filesystem as MEDIA_ROOT, so that the final move
+# is a rename instead of a copy.
+SUBMISSION_SPOOL_DIR = MEDIA_ROOT + 'spool/'
+
+# Directory holding every distinct submitted file once, named by its SHA-256.
+# The submission files below MEDIA_ROOT are hard links into it.
+SUBMISSION_BLOB_DIR = MEDIA_ROOT + 'blobs/'
+
+# How to handle a submission that is byte-identical to the last submission of
+# the same work and does not make the work final: 'store' it as usual,
+# 'reject' it as invalid or 'ignore' it, i.e. accept it without storing.
+IDENTICAL_RESUBMISSION_POLICY = 'store'
+
+# Store only the last submission of each work in full, and older ones as
+# deltas against the submission that followed them. See
+# knossos_aam_backend/submission_deltas.py.
+SUBMISSION_DELTA_STORAGE = False
+
+# Largest uncompressed k.zip, in bytes, that is stored as a delta. Encoding
+# and rebuilding deltas hold the members of the k.zip in memory.
+SUBMISSION_DELTA_MAX_SIZE = 64 * 2 ** 20
+
+# Days after which unfinished resumable uploads are discarded.
+UPLOAD_SESSION_MAX_AGE = 1.
+
+# Number of processes that each server process and submission worker forks
+# on its first submission, to run submission checks in parallel and with
+# SUBMISSION_CHECK_TIMEOUT. Each needs about the memory of a server process
+# plus that of the largest skeleton being checked. 0 runs the checks in the
+# calling process, one after the other and without timeout. Checks that
+# write to the database always run in the calling process. Submission
+# workers can override it with run_submission_worker --check-processes.
+SUBMISSION_CHECK_PROCESSES = 2
+
+# Seconds after which a running submission check is killed and the
+# submission rejected.
+SUBMISSION_CHECK_TIMEOUT = 60.
+
+# How task and submission files are delivered: 'django' streams them from
+# the server process, 'x-sendfile' (Apache mod_xsendfile) and
+# 'x-accel-redirect' (nginx) let the web server send them.
+FILE_DELIVERY_BACKEND = 'django'
+
+# For 'x-accel-redirect': internal nginx location that serves MEDIA_ROOT.
+FILE_DELIVERY_ACCEL_PREFIX = '/protected-media/'
+
+# Bytes of task files each server process keeps in memory, see
+# knossos_aam_backend/task_file_cache.py. 0 disables the cache. Only used
+# with FILE_DELIVERY_BACKEND = 'django'. Every server process fills its own
+# cache, so the memory of all caches is this times the number of processes.
+# Enough for the task files that are handed out at the same time, e.g. the
+# files of the tasks with the highest priority, is sufficient.
+TASK_FILE_CACHE_SIZE = 0
+
+# Larger task files are always read from disk.
+TASK_FILE_CACHE_MAX_FILE_SIZE = 32 * 2 ** 20
+
+# Select available tasks from in-memory queues per project, kept up to date
+# by model signals, instead of ranking them in the database on every
+# request. See knossos_aam_backend/task_dispatcher.py.
+TASK_DISPATCHER = False
+
+# Seconds after which the queues of a server process are rebuilt from the
+# database, to pick up changes made by other processes.
+TASK_DISPATCHER_MAX_AGE = 60.
+
+# E-mail notifications are queued in an outbox and sent by
+# knossos-aam run_mail_sender, see knossos_aam_backend/outbox.py. For
+# testing, point it at a local stand-in, e.g.
+# python -m smtpd -n -c DebuggingServer localhost:1025
+# with NOTIFICATION_SMTP_AUTH = NOTIFICATION_SMTPS = False.
+NOTIFICATION_SMTP_HOST = 'mail_host'
+NOTIFICATION_SMTP_PORT = 465
+NOTIFICATION_SMTP_AUTH = True
+NOTIFICATION_SMTPS = True
+NOTIFICATION_SMTP_USER = 'smtp_user'
+NOTIFICATION_SMTP_PASSWORD = 'smtp_pass'
+NOTIFICATION_SENDER = 'sender@example.com'
+NOTIFICATION_RECIPIENTS = ['recipient@example.com']
+
+# Attachments of queued notifications.
+NOTIFICATION_OUTBOX_DIR = MEDIA_ROOT + 'outbox/'
+
+# Combine all pending notifications to the same recipients into one digest
+# e-mail.
+NOTIFICATION_DIGEST = False
+
+# Maximum number of notifications sent per batch.
+NOTIFICATION_BATCH_SIZE = 50
+
+# Failed notifications are retried after NOTIFICATION_RETRY_DELAY seconds,
+# doubling the delay after every attempt, and given up after
+# NOTIFICATION_MAX_ATTEMPTS attempts.
+NOTIFICATION_RETRY_DELAY = 30.
+NOTIFICATION_MAX_ATTEMPTS = 8
+
+# The time overviews show TIMEOVERVIEW_PAGE_SIZE employees per page, and the
+# last TIMEOVERVIEW_DEFAULT_MONTHS months unless a range is requested.
+TIMEOVERVIEW_PAGE_SIZE = 100
+TIMEOVERVIEW_DEFAULT_MONTHS = 6
+
 # Absolute path to the directory static files should be collected to.
 # Don't put anything in this directory yourself; store your static files
 # in apps' "static/" subdirectories and in STATICFILES_DIRS.
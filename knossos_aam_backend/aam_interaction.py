@@ -5,24 +5,62 @@ logic goes here.
 
 __author__ = 'Fabian Svara'
 
+import datetime
+import hashlib
+import itertools
+import os
 import re
-import zipfile
-from cStringIO import StringIO
-
+import shutil
+import tempfile
+import xml.etree.cElementTree as ElementTree
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import default_storage
+from django.db import connection
 from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
 from django.utils import timezone
 from general_utilities.versions import compare_version
 from knossos_utils.skeleton import Skeleton
 
-import checks
+import check_registry
 import models
+import submission_deltas
+import task_dispatcher
 import view_helpers
+from check_runner import run_checks
+from enforce_model_constraints import task_coverage_update
+from helpers import CHUNK_SIZE
+from helpers import check_kzip
+from helpers import ensure_dir
+from helpers import hash_file
+from helpers import open_annotation
+from helpers import spool_upload
+from helpers import store_blob
 
 
 class NonEmptyWork(Exception):
     pass
 
 
+class InvalidAssignment(Exception):
+    pass
+
+
+class InvalidUploadChunk(Exception):
+    def __init__(self, message, offset):
+        super(InvalidUploadChunk, self).__init__(message)
+        # Offset the upload has to be resumed from
+        self.offset = offset
+
+
+@transaction.atomic
 def delete_submission(s):
     if s.worktime:
         s.work.worktime = s.work.worktime - s.worktime
@@ -82,10 +120,36 @@ def get_completed_work(em):
     return completed_work
 
 
+def _available_tasks(em):
+    # Categories in a subquery instead of a join, as SELECT ... FOR UPDATE
+    # in claim_task would otherwise lock the category rows as well.
+    return models.Task.objects.filter(
+        category__in=models.TaskCategory.objects.filter(
+            project_id=em.project_id).values('pk'),
+        is_active=True,
+        priority__gt=-1).exclude(employee=em).order_by()
+
+
+def get_best_available_task(em):
+    """
+    Return the available Task with the highest priority for employee em, or
+    None if there is none.
+    """
+
+    if em.project is None:
+        return None
+
+    return _available_tasks(em).order_by('-priority', 'pk').first()
+
+
 def get_available_tasks(em, count=1):
     """
     Return available tasks for employee em.
 
+    The count tasks with the highest priority of each category are ranked in
+    the database (ROW_NUMBER() over the category), so only these are loaded,
+    however many tasks there are.
+
     Parameters
     ----------
 
@@ -97,38 +161,88 @@ def get_available_tasks(em, count=1):
     Returns
     -------
 
-    available_tasks_by_cat : dict of str -> list Task instances
-        Maps category name to list of Tasks available in that category
+    available_tasks_by_cat : dict of TaskCategory -> list Task instances
+        Maps category to list of Tasks available in that category
         for employee em, where the tasks within the same category are sorted by
-        primary key
+        descending priority
 
     available_tasks : list of Task instances
-        Task instances sorted by primary key
+        The Tasks of available_tasks_by_cat, sorted by descending priority
     """
 
     available_tasks_by_cat = {}
-    available_tasks = []
 
     if em.project is None:
         return None, None
 
-    for curCategory in em.project.taskcategory_set.all():
-        cur_tasks = curCategory.task_set.filter(
-            is_active=True, priority__gt=-1).exclude(employee=em)
+    dispatcher = task_dispatcher.get_dispatcher()
+    if dispatcher is not None:
+        task_pks = []
+        for cur_task_pks in dispatcher.available_by_category(em, count).itervalues():
+            task_pks.extend(cur_task_pks)
+        # Confirmed in the database, as the queues may miss changes made by
+        # other processes.
+        available_tasks = sorted(
+            _available_tasks(em).in_bulk(task_pks).values(),
+            key=lambda x: (-x.priority, x.pk))
+    else:
+        qn = connection.ops.quote_name
+        task_table = qn(models.Task._meta.db_table)
+        ranked = _available_tasks(em).extra(select={
+            'category_rank': 'ROW_NUMBER() OVER (PARTITION BY {0}.{1} '
+                             'ORDER BY {0}.{2} DESC, {0}.{3})'.format(
+                task_table, qn('category_id'), qn('priority'), qn('id'))})
+        sql, params = ranked.query.sql_with_params()
+
+        available_tasks = list(models.Task.objects.raw(
+            'SELECT * FROM ({0}) ranked WHERE category_rank <= %s '
+            'ORDER BY priority DESC, id'.format(sql), params + (count,)))
+
+    categories = models.TaskCategory.objects.in_bulk(
+        set(x.category_id for x in available_tasks))
+    for t in available_tasks:
+        t.category = categories[t.category_id]
+        available_tasks_by_cat.setdefault(t.category, []).append(t)
 
-        if len(cur_tasks) > 0:
-            cur_tasks = list(cur_tasks)
-            cur_tasks = sorted(
-                cur_tasks, key=lambda x: x.priority, reverse=True)
-            available_tasks_by_cat[curCategory] = cur_tasks[0:count]
-            available_tasks.extend(cur_tasks)
+    return available_tasks_by_cat, available_tasks
 
-    available_tasks = sorted(
-        available_tasks, key=lambda x: x.priority, reverse=True)
 
-    return available_tasks_by_cat, available_tasks
+def task_file_etag(task):
+    """
+    Return the SHA-256 of the task file of task, which is computed once and
+    stored with the task. None if the task has no file.
+    """
+
+    if not task.task_file or task.task_file.name == 'False':
+        return None
+
+    if not task.task_file_sha256:
+        task.task_file_sha256 = hash_file(task.task_file.path)
+        # update(), as saving would run all Task constraints
+        models.Task.objects.filter(pk=task.pk).update(
+            task_file_sha256=task.task_file_sha256)
 
+    return task.task_file_sha256
 
+
+def submission_file_etag(s):
+    """
+    Return the SHA-256 of the datafile of Submission s, computing and storing
+    it for submissions from before hashes were stored. None if the file is
+    stored as a delta, as rebuilt files can differ in their bytes.
+    """
+
+    if s.delta_base_id is not None:
+        return None
+
+    if not s.sha256:
+        s.sha256 = hash_file(s.datafile.path)
+        models.Submission.objects.filter(pk=s.pk).update(sha256=s.sha256)
+
+    return s.sha256
+
+
+@transaction.atomic
 def reset_task(task, username):
     s = models.Submission.objects.filter(
         employee__user__username=username,
@@ -161,25 +275,305 @@ def cancel_task(task, username):
         raise NonEmptyWork('Submissions exist for this Work. Not deleting.')
 
 
-def choose_task(employee, task_id):
-    active_work = models.Work.objects.filter(
-        employee=employee, is_final=False)
-    if not len(active_work) == 0:
+def _create_work(employee, task):
+    models.Work.objects.create(
+        started=timezone.now(),
+        task=task,
+        employee=employee,
+        is_final=False, )
+
+
+def _lock_employee_without_active_work(employee):
+    # Serializes task requests of the same employee, so that no employee
+    # ends up with two active Works.
+    models.Employee.objects.select_for_update().get(pk=employee.pk)
+    if models.Work.objects.filter(employee=employee, is_final=False).exists():
         raise view_helpers.TooManyActiveTasks()
 
-    task = models.Task.objects.get(pk=task_id)
-    if task.target_coverage > task.current_coverage:
-        models.Work.objects.create(
-            started=timezone.now(),
-            task=models.Task.objects.get(pk=task_id),
-            employee=employee,
-            is_final=False, )
-    else:
-        raise view_helpers.UserRace()
+
+def choose_task(employee, task_id):
+    with transaction.atomic():
+        _lock_employee_without_active_work(employee)
+
+        task = models.Task.objects.select_for_update().get(pk=task_id)
+        if task.target_coverage > task.current_coverage:
+            _create_work(employee, task)
+        else:
+            raise view_helpers.UserRace()
 
     return
 
 
+# Number of times claim_task skips candidates that are locked by concurrent
+# claims, before it waits for their locks.
+CLAIM_ATTEMPTS = 5
+
+
+def _claim_dispatched_task(employee, dispatcher, skip_locked):
+    """
+    Claim the first candidate of the task dispatcher that is still claimable
+    in the database.
+    """
+
+    for task_pk in dispatcher.candidates(employee, CLAIM_ATTEMPTS):
+        claimable = _available_tasks(employee).filter(
+            pk=task_pk, current_coverage__lt=F('target_coverage'))
+        with transaction.atomic():
+            _lock_employee_without_active_work(employee)
+
+            task = claimable.select_for_update(skip_locked=skip_locked).first()
+            if task is not None:
+                _create_work(employee, task)
+                return task
+
+        # Locked by a concurrent claim, or the queue is out of date
+        if not claimable.exists():
+            dispatcher.drifted(employee)
+
+    return None
+
+
+def claim_task(employee):
+    """
+    Assign the available Task with the highest priority to employee by
+    creating an active Work for it. Safe to call concurrently: candidates
+    are locked (SELECT ... FOR UPDATE SKIP LOCKED), so concurrent claims
+    take the next candidate instead of overshooting its coverage. If only
+    locked candidates are left, it waits for their locks, so that it does
+    not give up while tasks are still available.
+
+    With TASK_DISPATCHER, candidates come from the in-memory queues of
+    task_dispatcher.py and are only confirmed in the database.
+
+    Parameters
+    ----------
+
+    employee : Employee instance
+
+    Returns
+    -------
+
+    task : Task instance or None
+        None if no task is available.
+
+    Raises
+    ------
+
+    TooManyActiveTasks:
+
+    if employee already has an active Work.
+    """
+
+    if employee.project is None:
+        return None
+
+    skip_locked = connection.features.has_select_for_update_skip_locked
+
+    dispatcher = task_dispatcher.get_dispatcher()
+    if dispatcher is not None:
+        task = _claim_dispatched_task(employee, dispatcher, skip_locked)
+        if task is not None:
+            return task
+        # Fall through, the queues may miss tasks added by other processes
+
+    candidates = _available_tasks(employee).filter(
+        current_coverage__lt=F('target_coverage')).order_by('-priority', 'pk')
+    attempt = 0
+    while True:
+        blocking = not skip_locked or attempt >= CLAIM_ATTEMPTS - 1
+        attempt += 1
+        with transaction.atomic():
+            _lock_employee_without_active_work(employee)
+
+            if blocking:
+                task_pk = candidates.values_list('pk', flat=True).first()
+                if task_pk is None:
+                    return None
+                task = models.Task.objects.select_for_update().filter(
+                    pk=task_pk).first()
+                # Filled or deleted while waiting for its lock, the next
+                # attempt takes the next candidate.
+                if task is None \
+                        or task.current_coverage >= task.target_coverage:
+                    continue
+            else:
+                task = candidates.select_for_update(skip_locked=True).first()
+
+            if task is not None:
+                _create_work(employee, task)
+                return task
+
+        # Rows locked by other claims may have been the only candidates
+        if not candidates.exists():
+            return None
+
+
+def round_robin_assignment(employee_pks, task_pks):
+    """
+    Distribute tasks over employees in turn, giving each task to as many
+    employees as its coverage allows and skipping employees that already
+    worked on it. Employees get at most one task, and none if they have an
+    active Work already.
+
+    Parameters
+    ----------
+
+    employee_pks : list of int
+
+    task_pks : list of int
+        In the order the tasks should be handed out.
+
+    Returns
+    -------
+
+    assignments : list of (int, int)
+        Pairs of employee pk and task pk, for bulk_assign_tasks
+    """
+
+    if not employee_pks:
+        return []
+
+    remaining = dict(
+        (pk, target - current) for pk, target, current in
+        models.Task.objects.filter(pk__in=task_pks).values_list(
+            'pk', 'target_coverage', 'current_coverage'))
+    worked = set(models.Work.objects.filter(
+        employee_id__in=employee_pks,
+        task_id__in=task_pks).values_list('employee_id', 'task_id'))
+    busy = set(models.Work.objects.filter(
+        employee_id__in=employee_pks,
+        is_final=False).values_list('employee_id', flat=True))
+
+    free = [x for x in employee_pks if x not in busy]
+    assignments = []
+    for task_pk in task_pks:
+        candidates = [x for x in free if (x, task_pk) not in worked]
+        chosen = candidates[0:max(0, remaining.get(task_pk, 0))]
+        assignments.extend((x, task_pk) for x in chosen)
+        free = [x for x in free if x not in chosen]
+
+    return assignments
+
+
+def bulk_assign_tasks(assignments):
+    """
+    Create active Works for many (employee, task) pairs at once, e.g. to
+    staff a new category. Works are created with bulk_create, and the
+    coverage of the tasks is updated in one statement per distinct
+    increment, without the per-row signals of Work.
+
+    Like claim_task, employees get no second active Work, and only tasks
+    of their project. Pairs that violate this are skipped.
+
+    Parameters
+    ----------
+
+    assignments : list of (int, int)
+        Pairs of employee pk and task pk
+
+    Returns
+    -------
+
+    count : int
+        Number of Works created
+
+    skipped : list of (int, int, str)
+        Employee pk, task pk and reason of the pairs that were skipped
+
+    Raises
+    ------
+
+    InvalidAssignment:
+
+    if a pair is repeated or exists already, or a task would exceed its
+    target coverage. Nothing is created then.
+    """
+
+    if len(set(assignments)) != len(assignments):
+        raise InvalidAssignment('Repeated employee / task pairs.')
+
+    employee_pks = set(x[0] for x in assignments)
+    task_pks = set(x[1] for x in assignments)
+
+    with transaction.atomic():
+        # Locked in a fixed order, employees before tasks like claim_task,
+        # so that concurrent calls cannot deadlock.
+        employees = models.Employee.objects.select_for_update().filter(
+            pk__in=employee_pks).order_by('pk')
+        projects = dict((x.pk, x.project_id) for x in employees)
+        tasks = models.Task.objects.select_for_update().filter(
+            pk__in=task_pks).order_by('pk')
+        tasks = dict((x.pk, x) for x in tasks)
+
+        errors = []
+        missing = task_pks - set(tasks.keys())
+        if missing:
+            errors.append('Unknown tasks: {0}'.format(sorted(missing)))
+        missing = employee_pks - set(projects.keys())
+        if missing:
+            errors.append('Unknown employees: {0}'.format(sorted(missing)))
+        if errors:
+            raise InvalidAssignment('\n'.join(errors))
+
+        task_projects = dict(models.Task.objects.filter(
+            pk__in=task_pks).values_list('pk', 'category__project_id'))
+        busy = set(models.Work.objects.filter(
+            employee_id__in=employee_pks,
+            is_final=False).values_list('employee_id', flat=True))
+        skipped = []
+        accepted = []
+        for employee_pk, task_pk in assignments:
+            if employee_pk in busy:
+                skipped.append((employee_pk, task_pk, 'active work'))
+            elif task_projects[task_pk] != projects[employee_pk]:
+                skipped.append((employee_pk, task_pk, 'other project'))
+            else:
+                accepted.append((employee_pk, task_pk))
+                busy.add(employee_pk)
+        assignments = accepted
+
+        increments = {}
+        for _, task_pk in assignments:
+            increments[task_pk] = increments.get(task_pk, 0) + 1
+
+        for task_pk, increment in sorted(increments.iteritems()):
+            task = tasks[task_pk]
+            if task.current_coverage + increment > task.target_coverage:
+                errors.append('{0}: {1} more works exceed the target '
+                              'coverage of {2}.'.format(
+                    task.category_name_combination, increment,
+                    task.target_coverage))
+        existing = models.Work.objects.filter(
+            employee_id__in=employee_pks,
+            task_id__in=task_pks).values_list('employee_id', 'task_id')
+        existing = set(existing) & set(assignments)
+        if existing:
+            errors.append('Works exist already for (employee, task): '
+                          '{0}'.format(sorted(existing)))
+        if errors:
+            raise InvalidAssignment('\n'.join(errors))
+
+        now = timezone.now()
+        models.Work.objects.bulk_create([
+            models.Work(started=now, task_id=task_pk, employee_id=employee_pk,
+                        is_final=False)
+            for employee_pk, task_pk in assignments], batch_size=1000)
+
+        by_increment = {}
+        for task_pk, increment in increments.iteritems():
+            by_increment.setdefault(increment, []).append(task_pk)
+        for increment, pks in by_increment.iteritems():
+            models.Task.objects.filter(pk__in=pks).update(
+                **task_coverage_update(increment))
+
+    # bulk_create sends no signals
+    dispatcher = task_dispatcher.get_dispatcher()
+    if dispatcher is not None:
+        dispatcher.invalidate()
+
+    return len(assignments), skipped
+
+
 def submit(employee, submit_file, submit_comment, submit_is_final,
            submit_work_id, skip_checks=False):
     """Parses the submitted file, extracts the worktime and tests the nml.
@@ -250,109 +644,539 @@ def submit(employee, submit_file, submit_comment, submit_is_final,
 
     work = models.Work.objects.get(pk=submit_work_id)
 
-    # testing for .k.zip is problematic, just do zip - django itself removes
-    # the k sometimes (e.g. when changing the filename of task files
-    # on uploading them by adding random chars)
-    if submit_file.name.endswith('.zip'):
-        fp = StringIO(submit_file.read())
-        zipper = zipfile.ZipFile(fp, 'r')
+    # The upload is spooled to disk once and only streamed from there on, so
+    # that memory use does not grow with the size of the submission.
+    spool_path, sha256 = spool_upload(submit_file)
+    try:
+        if _ignore_identical_resubmission(work, sha256, submit_is_final):
+            return
 
-        if 'annotation.xml' not in zipper.namelist():
-            raise Exception('k.zip broken.')
+        _ingest_spooled_submission(
+            employee, work, submit_file, spool_path, sha256, submit_comment,
+            submit_is_final, timezone.now(), skip_checks)
+    finally:
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
 
-        skeleton_file_as_string = zipper.read('annotation.xml')
-    else:
-        skeleton_file_as_string = submit_file.read()
-
-    checks_to_run = re.split('\W', work.task.checks)
-    checks_to_run = [x for x in checks_to_run if x]
-    if checks_to_run and not skip_checks:
-        check_fns = dict()
-        for cur_check in checks_to_run:
-            exec ('from knossos_aam_backend.checks import {0}'.format(cur_check))
-            cur_check_fn = locals()[cur_check]
-            check_fns[cur_check] = cur_check_fn
-
-        skeleton = Skeleton()
-        skeleton.fromNmlString(skeleton_file_as_string,
-                               use_file_scaling=True)
-
-        # Keyword arguments for check functions
-        #
-
-        kwargs = {'skeleton': skeleton,
-                  'work': work,
-                  'employee': employee,
-                  'submit_file': submit_file,
-                  'submit_comment': submit_comment,
-                  'submit_work_id': submit_work_id,
-                  'submit_is_final': submit_is_final,
-                  'submit_file_as_string': skeleton_file_as_string, }
-
-        # Check whether the knossos version is high enough
-
-        version = skeleton.get_version()
-
-        # Has work time tracking
-        if compare_version(version['saved'], (4, 1, 2)) == '<':
-            raise view_helpers.InvalidSubmission(
-                "This tracing was saved in a version "
-                "of Knossos that is too old and incompatible with "
-                "knossos_aam. Please upgrade to version 4.1.2, "
-                "available "
-                "from www.knossostool.org, save the file again in "
-                "that version, and resubmit.")
-        else:
-            # All fine, newest version.
-            pass
 
-        if 'automatic_worktime' not in checks_to_run:
-            incremental_worktime = None
-            auto_worktime = False
-            output = checks.automatic_worktime(**kwargs)
-        else:
-            auto_worktime = True
-            output = checks.automatic_worktime(**kwargs)
-            if type(output) == str:
-                raise view_helpers.InvalidSubmission(output)
-            else:
-                incremental_worktime = output
-            del check_fns['automatic_worktime']
+def submit_async(employee, submit_file, submit_comment, submit_is_final,
+                 submit_work_id):
+    """
+    Store a submission for checking by a submission worker (see the
+    run_submission_worker management command) instead of checking it
+    during the request.
 
-        # Here is the part where the tests are done
-        #
-        for cur_check in check_fns:
-            output = eval(cur_check)(**kwargs)
-            if type(output) == str:
-                raise view_helpers.InvalidSubmission(output)
+    Parameters and exceptions are the same as for submit, except that
+    check failures are only reported through the returned job.
 
-        if 'automatic_worktime' in checks_to_run and incremental_worktime:
-            work.worktime = work.worktime + incremental_worktime
-            work.save()
+    Returns
+    -------
 
-    else:
-        incremental_worktime = None
-        auto_worktime = False
+    job : SubmissionJob instance
+        Pending job. The Submission is only created, and only becomes the
+        last_submission of its Work, once the checks of the task passed.
+    """
+
+    if len(submit_file.name) > 200:
+        raise view_helpers.InvalidSubmission(
+            'The maximal file name length for submissions is '
+            '200 character.')
+
+    work = models.Work.objects.get(pk=submit_work_id)
+
+    spool_path, sha256 = spool_upload(submit_file)
+    try:
+        job = models.SubmissionJob(
+            employee=employee,
+            work=work,
+            date=timezone.now(),
+            comment=submit_comment,
+            is_final=submit_is_final,
+            original_filename=submit_file.name[0:200],
+            spool_path=spool_path,
+            sha256=sha256, )
+
+        if _ignore_identical_resubmission(work, sha256, submit_is_final):
+            os.remove(spool_path)
+            job.status = models.SubmissionJob.PASS
+            job.submission = work.last_submission
+            job.finished = job.date
+
+        job.save()
+    except:
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        raise
+
+    return job
+
+
+def create_upload_session(employee, filename, size, submit_comment,
+                          submit_is_final, submit_is_async):
+    """
+    Start a resumable upload of a submission file. Unfinished uploads of
+    employee older than UPLOAD_SESSION_MAX_AGE are discarded.
+
+    Returns
+    -------
+
+    upload_session : UploadSession instance
+
+    Raises
+    ------
+
+    InvalidSubmission:
+
+    if the filename is longer than 200 characters
+    """
+
+    if len(filename) > 200:
+        raise view_helpers.InvalidSubmission(
+            'The maximal file name length for submissions is '
+            '200 character.')
+
+    max_age = datetime.timedelta(settings.UPLOAD_SESSION_MAX_AGE)
+    for cur_session in models.UploadSession.objects.filter(
+            employee=employee, created__lt=timezone.now() - max_age):
+        delete_upload_session(cur_session)
+
+    ensure_dir(settings.SUBMISSION_SPOOL_DIR)
+    fd, path = tempfile.mkstemp(suffix='.upload',
+                                dir=settings.SUBMISSION_SPOOL_DIR)
+    os.close(fd)
+
+    return models.UploadSession.objects.create(
+        employee=employee,
+        filename=filename,
+        size=size,
+        path=path,
+        comment=submit_comment,
+        is_final=submit_is_final,
+        is_async=submit_is_async, )
+
+
+def write_upload_chunk(upload_session, offset, stream, sha256):
+    """
+    Write the chunk read from stream to the upload at offset. Data after
+    offset that was received before is discarded, so chunks can be sent
+    again.
+
+    Parameters
+    ----------
+
+    upload_session : UploadSession instance
+
+    offset : int
+
+    stream : file-like object
+
+    sha256 : str
+        SHA-256 hex digest of the chunk
+
+    Returns
+    -------
+
+    upload_session : UploadSession instance
+        Updated upload session
+
+    Raises
+    ------
+
+    InvalidUploadChunk:
+
+    if offset is beyond the data received so far, or the chunk does not
+    match sha256. The chunk is discarded.
+    """
+
+    if offset > upload_session.received:
+        raise InvalidUploadChunk(
+            'Chunk starts after the received data.', upload_session.received)
+
+    # The chunk is received before the upload session is locked, so that a
+    # slow client does not hold the lock.
+    digest = hashlib.sha256()
+    with tempfile.TemporaryFile(dir=settings.SUBMISSION_SPOOL_DIR) as chunk_fp:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            chunk_fp.write(chunk)
+
+        if digest.hexdigest() != sha256.lower():
+            raise InvalidUploadChunk(
+                'Chunk does not match its checksum.', offset)
+
+        with transaction.atomic():
+            sessions = models.UploadSession.objects.select_for_update()
+            upload_session = sessions.get(pk=upload_session.pk)
+            if offset > upload_session.received:
+                raise InvalidUploadChunk(
+                    'Chunk starts after the received data.',
+                    upload_session.received)
+
+            chunk_fp.seek(0)
+            with open(upload_session.path, 'r+b') as fp:
+                fp.seek(offset)
+                fp.truncate()
+                shutil.copyfileobj(chunk_fp, fp, CHUNK_SIZE)
+                upload_session.received = fp.tell()
+
+            upload_session.save()
+
+    return upload_session
+
+
+def delete_upload_session(upload_session):
+    if os.path.exists(upload_session.path):
+        os.remove(upload_session.path)
+    upload_session.delete()
+
+
+def _ignore_identical_resubmission(work, sha256, submit_is_final):
+    """
+    Apply IDENTICAL_RESUBMISSION_POLICY to a submission to work with
+    contents hash sha256.
+
+    Returns True if the submission is to be ignored.
+
+    Raises InvalidSubmission if it is to be rejected.
+    """
+
+    last_submission = work.last_submission
+    if settings.IDENTICAL_RESUBMISSION_POLICY == 'store' \
+            or last_submission is None \
+            or last_submission.sha256 != sha256:
+        return False
+
+    if submit_is_final and not last_submission.is_final:
+        # Making the work final is a change, even if the file is the same.
+        return False
+
+    if settings.IDENTICAL_RESUBMISSION_POLICY == 'reject':
+        raise view_helpers.InvalidSubmission(
+            'This submission is identical to your last submission.')
+
+    return True
+
+
+def process_next_submission_job():
+    """
+    Run the checks on the oldest pending SubmissionJob and create its
+    Submission if they pass. Jobs of the same Work are processed in the
+    order they were submitted, jobs of different Works can be processed by
+    several workers at the same time.
+
+    Returns
+    -------
+
+    processed : bool
+        False if there was no job that could be processed right now.
+    """
+
+    with transaction.atomic():
+        # Locks the job together with its Work. Jobs whose Work is locked,
+        # e.g. by a worker that processes another job of it, are skipped
+        # and stay pending, instead of blocking this worker.
+        job = models.SubmissionJob.objects.select_related(
+            'work').select_for_update(skip_locked=True).filter(
+            status=models.SubmissionJob.PENDING).order_by('pk').first()
+        if job is None:
+            return False
+
+        # Checks compare against the worktime of previous submissions, so
+        # jobs of the same Work must not overtake each other.
+        work = job.work
+        if models.SubmissionJob.objects.filter(
+                work=work,
+                status=models.SubmissionJob.PENDING,
+                pk__lt=job.pk).exists():
+            return False
+
+        try:
+            with transaction.atomic():
+                with open(job.spool_path, 'rb') as fp:
+                    s = _ingest_spooled_submission(
+                        job.employee, work, File(fp, name=job.original_filename),
+                        job.spool_path, job.sha256, job.comment, job.is_final,
+                        job.date)
+            job.status = models.SubmissionJob.PASS
+            job.submission = s
+        except view_helpers.InvalidSubmission, e:
+            job.status = models.SubmissionJob.FAIL
+            job.message = 'Invalid submission: ' + str(e)
+        except view_helpers.ParseError:
+            job.status = models.SubmissionJob.FAIL
+            job.message = ('Error parsing file. The file may be corrupt. '
+                           'Please contact the admin team for assistance.')
+        except Exception, e:
+            job.status = models.SubmissionJob.FAIL
+            job.message = 'Error while checking submission: ' + str(e)
+
+        job.finished = timezone.now()
+        job.save()
+
+    if os.path.exists(job.spool_path):
+        os.remove(job.spool_path)
+
+    return True
+
+
+def _ingest_spooled_submission(employee, work, submit_file, spool_path,
+                               sha256, submit_comment, submit_is_final, date,
+                               skip_checks=False):
+    """
+    Run the checks on the upload spooled to spool_path, with contents hash
+    sha256, and store it as a new Submission, which is returned.
+    """
+
+    # testing for .k.zip is problematic, just do zip - django itself
+    # removes the k sometimes (e.g. when changing the filename of task
+    # files on uploading them by adding random chars)
+    is_zip = submit_file.name.endswith('.zip')
+    if is_zip:
+        # Also for tasks without checks, which never open the annotation
+        check_kzip(spool_path)
+
+    incremental_worktime = _run_submission_checks(
+        employee, work, submit_file, spool_path, is_zip, submit_comment,
+        submit_is_final, work.pk, skip_checks)
 
     # Send e-mail if comment is added to submission.
 
-    if submit_comment:
-        subject = 'Comment on Submission of Task {0} Task from {1}'.format(work.task.name, employee.user.username)
-        attachments = [(skeleton_file_as_string, submit_file.name)]
-        # todo get mailing to work again
-        # mail_notify('to@example.com', subject, submit_comment,
-        #            attachments=attachments, reply_to=work.employee.user.email)
+    # todo get mailing to work again
+    # if submit_comment:
+    #     subject = 'Comment on Submission of Task {0} Task from {1}'.format(work.task.name, employee.user.username)
+    #     attachments = [(spool_path, submit_file.name)]
+    #     mail_notify('to@example.com', subject, submit_comment,
+    #                 attachments=attachments, reply_to=work.employee.user.email)
 
-    s = models.Submission.objects.create(
+    previous_submission = work.last_submission
+
+    s = models.Submission(
         employee=employee,
-        date=timezone.now(),
+        date=date,
         work=work,
         comment=submit_comment,
         is_final=submit_is_final,
         worktime=incremental_worktime,
         original_filename=submit_file.name[0:200],
-        datafile=submit_file, )
-    s.save()
+        sha256=sha256, )
+    store_spooled_submission(s, spool_path)
+
+    if settings.SUBMISSION_DELTA_STORAGE and previous_submission is not None \
+            and previous_submission.delta_base_id is None:
+        submission_deltas.store_as_delta(previous_submission, s)
+
+    return s
+
+
+def _run_submission_checks(employee, work, submit_file, spool_path, is_zip,
+                           submit_comment, submit_is_final, submit_work_id,
+                           skip_checks):
+    """
+    Run the checks configured for work.task on the spooled submission at
+    spool_path and return the incremental worktime (None if the worktime is
+    not determined automatically).
+    """
+
+    checks_to_run = check_registry.parse_checks(work.task.checks)
+    if not checks_to_run or skip_checks:
+        return None
+
+    check_fns = check_registry.get_task_check_fns(work.task)
+
+    with open_annotation(spool_path, is_zip) as fp:
+        annotation_header = read_annotation_header(fp)
+
+    # Keyword arguments for check functions
+    #
+
+    kwargs = {'skeleton': None,
+              'annotation_header': annotation_header,
+              'work': work,
+              'employee': employee,
+              # Only the name, as kwargs need to be sent to the check
+              # processes
+              'submit_file': File(None, name=submit_file.name),
+              'submit_comment': submit_comment,
+              'submit_work_id': submit_work_id,
+              'submit_is_final': submit_is_final,
+              'submit_file_as_string': None, }
+
+    # Check whether the knossos version is high enough
+
+    version = annotation_header['version']
+
+    # Has work time tracking. Files without lastsavedin are accepted.
+    if version['saved'] is not None \
+            and compare_version(version['saved'], (4, 1, 2)) == '<':
+        raise view_helpers.InvalidSubmission(
+            "This tracing was saved in a version "
+            "of Knossos that is too old and incompatible with "
+            "knossos_aam. Please upgrade to version 4.1.2, "
+            "available "
+            "from www.knossostool.org, save the file again in "
+            "that version, and resubmit.")
+    else:
+        # All fine, newest version.
+        pass
+
+    # Here is the part where the tests are done. The checks run in
+    # parallel; the full skeleton is only built for checks that need the
+    # graph.
+    #
+    results = run_checks(
+        check_fns, kwargs, (load_skeleton, (spool_path, is_zip)))
+
+    if 'automatic_worktime' not in checks_to_run:
+        incremental_worktime = None
+    else:
+        output = results['automatic_worktime'].output
+        if type(output) == str:
+            raise view_helpers.InvalidSubmission(output)
+        else:
+            incremental_worktime = output
+
+    for cur_check in checks_to_run:
+        output = results[cur_check].output
+        if type(output) == str:
+            raise view_helpers.InvalidSubmission(output)
+
+    if 'automatic_worktime' in checks_to_run and incremental_worktime:
+        work.worktime = work.worktime + incremental_worktime
+        work.save()
+
+    return incremental_worktime
+
+
+def load_skeleton(spool_path, is_zip):
+    """
+    Parse the annotation.xml of the spooled submission at spool_path.
+    Returns the check keyword arguments skeleton and submit_file_as_string.
+    """
+
+    # The skeleton parser needs the whole document, but only the
+    # decompressed annotation.xml is materialized, never the upload itself.
+    with open_annotation(spool_path, is_zip) as fp:
+        skeleton_file_as_string = fp.read()
+
+    skeleton = Skeleton()
+    skeleton.fromNmlString(skeleton_file_as_string,
+                           use_file_scaling=True)
+
+    return {'skeleton': skeleton,
+            'submit_file_as_string': skeleton_file_as_string, }
+
+
+def _parse_version(version_string):
+    if version_string is None:
+        return None
+    return tuple(int(x) for x in re.findall(r'\d+', version_string))
+
+
+def read_annotation_header(fp):
+    """
+    Read the <parameters> block of an annotation.xml incrementally and stop
+    before the node and edge lists, which are never parsed.
+
+    Parameters
+    ----------
+
+    fp : file object
+        annotation.xml stream, e.g. from helpers.open_annotation
+
+    Returns
+    -------
+
+    header : dict
+        'version': {'created': tuple of int, 'saved': tuple of int}, None
+            for versions missing from the file, which the version check
+            tolerates
+        'time': skeleton time in ms
+        'idle_time': idle time in ms
+
+    Raises
+    ------
+
+    ParseError:
+
+    if the header is not well-formed xml.
+    """
+
+    header = {'version': {'created': None, 'saved': None},
+              'time': 0.,
+              'idle_time': 0., }
+
+    try:
+        for event, elem in ElementTree.iterparse(fp, events=('end',)):
+            if elem.tag == 'lastsavedin':
+                header['version']['saved'] = _parse_version(elem.get('version'))
+            elif elem.tag == 'createdin':
+                header['version']['created'] = _parse_version(elem.get('version'))
+            elif elem.tag == 'time':
+                header['time'] = float(elem.get('ms', 0))
+            elif elem.tag == 'idleTime':
+                header['idle_time'] = float(elem.get('ms', 0))
+            elif elem.tag == 'parameters':
+                break
+            # Files without <parameters> are read to the end, keep memory
+            # use flat meanwhile
+            elem.clear()
+    except (SyntaxError, ValueError), e:
+        raise view_helpers.ParseError(str(e))
+
+    return header
+
+
+def store_spooled_submission(s, spool_path):
+    """
+    Store the spooled upload at spool_path as the datafile of the unsaved
+    Submission s and save s.
+
+    The contents are stored once per distinct s.sha256 in
+    SUBMISSION_BLOB_DIR, and the datafile is a hard link to that blob. The
+    upload is renamed, not copied, as long as the spool and blob directories
+    are on the same filesystem as MEDIA_ROOT.
+    """
+
+    name = s.datafile.field.generate_filename(s, s.original_filename)
+    name = default_storage.get_available_name(name)
+    abs_path = default_storage.path(name)
+
+    ensure_dir(os.path.dirname(abs_path))
+    if s.sha256:
+        store_blob(spool_path, s.sha256, abs_path)
+    else:
+        file_move_safe(spool_path, abs_path)
+    s.datafile.name = name
+
+    try:
+        # Together with the Work and the monthly worktime, which the
+        # Submission signals update
+        with transaction.atomic():
+            s.save()
+    except:
+        os.remove(abs_path)
+        raise
+
+
+def monthly_worktime_rows(submission_set, *fields):
+    """
+    Returns
+    -------
+
+    rows : ValuesQuerySet
+        Dicts with the month (first day, in TIME_ZONE), task id, summed
+        worktime (total_worktime) and the number of submissions with and without worktime
+        of submission_set, grouped by month, task and the Submission fields
+        given in fields.
+    """
+
+    return submission_set.order_by().annotate(
+        month=TruncMonth('date', tzinfo=timezone.get_default_timezone()),
+    ).values('month', 'work__task', *fields).annotate(
+        # Not named worktime, Count('worktime') could refer to it otherwise
+        total_worktime=Sum('worktime'),
+        submissions=Count('pk'),
+        timed_submissions=Count('worktime'), )
 
 
 def get_monthly_worktime_for_submissions(submission_set):
@@ -371,51 +1195,255 @@ def get_monthly_worktime_for_submissions(submission_set):
 
     """
 
+    # Aggregated by the database, independent of the number of submissions
+    rows = list(monthly_worktime_rows(submission_set))
+    tasks = models.Task.objects.in_bulk(set(x['work__task'] for x in rows))
+
+    return _monthly_worktime_overview(
+        (x['month'].year,
+         x['month'].month,
+         tasks[x['work__task']],
+         x['total_worktime'] or 0.,
+         x['timed_submissions'] < x['submissions'])
+        for x in sorted(rows, key=lambda x: x['month']))
+
+
+def get_monthly_worktime(worktime_set):
+    """
+    Like get_monthly_worktime_for_submissions, but reads the monthly
+    worktime rollup.
+
+    Parameters
+    ----------
+
+    worktime_set : QuerySet(MonthlyWorktime)
+    """
+
+    return _monthly_worktime_overview(
+        (x.year, x.month, x.task, x.worktime, x.incomplete_time)
+        for x in worktime_set.select_related('task').order_by('year', 'month'))
+
+
+def get_monthly_worktime_by_employee(worktime_set):
+    """
+    get_monthly_worktime for the rows of many employees, with one query.
+
+    Parameters
+    ----------
+
+    worktime_set : QuerySet(MonthlyWorktime)
+
+    Returns
+    -------
+
+    set {by_month_per_task, by_month_totals}
+
+    Both map Employee to the respective dict of get_monthly_worktime.
+    Employees without rows in worktime_set are left out.
+    """
+
     by_month_per_task = {}
     by_month_totals = {}
 
-    s = submission_set.order_by('date')
+    rows = worktime_set.select_related(
+        'employee__user', 'employee__project', 'task').order_by(
+        'employee', 'year', 'month')
+    for _, employee_rows in itertools.groupby(rows, lambda x: x.employee_id):
+        employee_rows = list(employee_rows)
+        overview = _monthly_worktime_overview(
+            (x.year, x.month, x.task, x.worktime, x.incomplete_time)
+            for x in employee_rows)
 
-    for curs in s:
-        year = curs.date.year
-        month = curs.date.month
-        task = curs.work.task
+        e = employee_rows[0].employee
+        by_month_per_task[e] = overview['by_month_per_task']
+        by_month_totals[e] = overview['by_month_totals']
 
-        incomplete_time = False
+    return {'by_month_per_task': by_month_per_task,
+            'by_month_totals': by_month_totals, }
 
-        if curs.worktime is None:
-            cur_worktime = 0.
-            incomplete_time = True
-        else:
-            cur_worktime = curs.worktime
-
-        if year not in by_month_per_task:
-            by_month_per_task[year] = {}
-            by_month_totals[year] = {}
-        if month not in by_month_per_task[year]:
-            by_month_per_task[year][month] = {}
-            # Second item in tuple indicates whether the worktime
-            # is incomplete, i.e. work was performed on tasks
-            # for which worktime is not automatically computed
-            by_month_totals[year][month] = [0, False]
-        if task not in by_month_per_task[year][month]:
-            by_month_per_task[year][month][task] = [0, False]
-
-        if incomplete_time:
-            by_month_per_task[year][month][task][1] = True
-            by_month_totals[year][month][1] = True
-
-        by_month_per_task[year][month][task][0] = \
-            by_month_per_task[year][month][task][0] + cur_worktime
-        by_month_totals[year][month][0] = \
-            by_month_totals[year][month][0] + cur_worktime
+
+def get_monthly_worktime_by_project(worktime_set):
+    """
+    Like get_monthly_worktime_by_employee, but both dicts map every Project
+    to the dict of its employees. Employees without project are left out.
+    """
+
+    overview = get_monthly_worktime_by_employee(
+        worktime_set.filter(employee__project__isnull=False))
+
+    projects = list(models.Project.objects.all())
+    by_project = {}
+    for key, by_employee in overview.iteritems():
+        by_project[key] = dict((p, {}) for p in projects)
+        for e, months in by_employee.iteritems():
+            by_project[key].setdefault(e.project, {})[e] = months
+
+    return by_project
+
+
+def parse_month(value):
+    """
+    Parse a month given as YYYY-MM.
+
+    Returns
+    -------
+
+    month : (int, int)
+        Year and month.
+
+    Raises
+    ------
+
+    ValueError
+        If value is no valid month.
+    """
+
+    date = datetime.datetime.strptime(value, '%Y-%m')
+    return date.year, date.month
+
+
+def monthly_worktime_in_range(worktime_set, start=None, end=None):
+    """
+    Restrict the MonthlyWorktime QuerySet worktime_set to the months from
+    start to end, both (year, month) and included. None is unbounded.
+    """
+
+    if start is not None:
+        worktime_set = worktime_set.filter(
+            Q(year__gt=start[0]) | Q(year=start[0], month__gte=start[1]))
+    if end is not None:
+        worktime_set = worktime_set.filter(
+            Q(year__lt=end[0]) | Q(year=end[0], month__lte=end[1]))
+
+    return worktime_set
+
+
+def last_months(count):
+    """
+    Returns
+    -------
+
+    start : (int, int)
+        Year and month, in TIME_ZONE, of the first of the last count months
+        including the current one.
+    """
+
+    today = timezone.localtime(timezone.now(), timezone.get_default_timezone())
+    index = today.year * 12 + today.month - 1 - (count - 1)
+
+    return index // 12, index % 12 + 1
+
+
+def monthly_worktime_page(worktime_set, after, page_size):
+    """
+    Keyset pagination of the MonthlyWorktime QuerySet worktime_set by
+    employee.
+
+    Parameters
+    ----------
+
+    after : int or None
+        Only employees with a larger pk are on the page, None for the first
+        page.
+
+    page_size : int
+        Number of employees per page.
+
+    Returns
+    -------
+
+    worktime_set : QuerySet(MonthlyWorktime)
+        The rows of the employees on the page.
+
+    next_after : int or None
+        after of the next page, None if this is the last page.
+    """
+
+    employees = worktime_set.order_by('employee').values_list(
+        'employee', flat=True).distinct()
+    if after is not None:
+        employees = employees.filter(employee__gt=after)
+    employee_pks = list(employees[:page_size + 1])
+
+    next_after = None
+    if len(employee_pks) > page_size:
+        employee_pks = employee_pks[:page_size]
+        next_after = employee_pks[-1]
+
+    return worktime_set.filter(employee__in=employee_pks), next_after
+
+
+def _monthly_worktime_overview(rows):
+    """
+    Build the dicts of get_monthly_worktime_for_submissions from rows of
+    (year, month, task, worktime, incomplete_time), with one row per task
+    and month.
+    """
+
+    by_month_per_task = {}
+    by_month_totals = {}
+
+    for year, month, task, cur_worktime, incomplete_time in rows:
+        # Second item indicates whether the worktime is incomplete, i.e.
+        # work was performed on tasks for which worktime is not
+        # automatically computed
+        by_month_per_task.setdefault(year, {}).setdefault(month, {})[task] = \
+            [cur_worktime, incomplete_time]
+
+        total = by_month_totals.setdefault(year, {}).setdefault(month, [0, False])
+        total[0] = total[0] + cur_worktime
+        total[1] = total[1] or incomplete_time
 
     return {'by_month_per_task': by_month_per_task,
             'by_month_totals': by_month_totals, }
 
 
 def get_monthly_worktime_for_work(w):
-    return get_monthly_worktime_for_submissions(w.submission_set)
+    return get_monthly_worktime(models.MonthlyWorktime.objects.filter(
+        employee_id=w.employee_id, task_id=w.task_id))
+
+
+@transaction.atomic
+def rebuild_monthly_worktime():
+    """
+    Rebuild the monthly worktime rollup from all submissions. On
+    PostgreSQL, submissions are blocked meanwhile. Other databases have no
+    such lock, rebuild while no submissions are made there.
+
+    Returns
+    -------
+
+    count : int
+        Number of MonthlyWorktime rows.
+    """
+
+    # Submissions made or deleted meanwhile would be missed by the rollup
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE {0} IN SHARE MODE'.format(
+                models.Submission._meta.db_table))
+
+    models.MonthlyWorktime.objects.all().delete()
+
+    rows = monthly_worktime_rows(models.Submission.objects.all(), 'employee')
+    count = 0
+    batch = []
+    for row in rows.iterator():
+        batch.append(models.MonthlyWorktime(
+            employee_id=row['employee'],
+            task_id=row['work__task'],
+            year=row['month'].year,
+            month=row['month'].month,
+            worktime=row['total_worktime'] or 0.,
+            submissions=row['submissions'],
+            untimed_submissions=row['submissions'] - row['timed_submissions']))
+        if len(batch) >= 1000:
+            models.MonthlyWorktime.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    models.MonthlyWorktime.objects.bulk_create(batch)
+
+    return count + len(batch)
 
 
 def get_employee_info(emp):
@@ -1,10 +1,13 @@
 from django.contrib import admin
 
 from models import Employee
+from models import OutboxMessage
 from models import Project
 from models import Submission
+from models import SubmissionJob
 from models import Task
 from models import TaskCategory
+from models import TaskImport
 from models import Work
 
 
@@ -23,3 +26,6 @@ admin.site.register(Employee, EmployeeAdmin)
 admin.site.register(Task)
 admin.site.register(Work)
 admin.site.register(Submission)
+admin.site.register(SubmissionJob)
+admin.site.register(OutboxMessage)
+admin.site.register(TaskImport)
@@ -0,0 +1,89 @@
+"""
+Resolves check names to the functions in checks.py. The functions are looked
+up once per process and checks.py is only reloaded when its modification time
+changes, so that checks can still be changed while the server is running.
+"""
+
+import os
+import re
+from inspect import getmembers
+from inspect import isfunction
+from threading import Lock
+
+import checks
+
+_lock = Lock()
+_checks_mtime = None
+_check_fns = {}
+# Parsed check lists, by the checks string of a Task
+_parsed_checks = {}
+
+
+def _checks_source_path():
+    return os.path.splitext(checks.__file__)[0] + '.py'
+
+
+def get_check_fns():
+    """
+    Returns
+    -------
+
+    check_fns : dict of str -> function
+        All checks currently defined in checks.py
+    """
+
+    global _checks_mtime, _check_fns
+
+    mtime = os.path.getmtime(_checks_source_path())
+    with _lock:
+        if mtime != _checks_mtime:
+            if _checks_mtime is not None:
+                reload(checks)
+            _check_fns = dict(
+                [i for i in getmembers(checks) if isfunction(i[1])])
+            _checks_mtime = mtime
+
+        return _check_fns
+
+
+def available_checks():
+    return sorted(get_check_fns().keys())
+
+
+def parse_checks(checks_string):
+    """
+    Split the checks string of a Task into check names.
+    """
+
+    try:
+        return _parsed_checks[checks_string]
+    except KeyError:
+        names = [x for x in re.split(r'\W', checks_string) if x]
+        _parsed_checks[checks_string] = names
+        return names
+
+
+def get_task_check_fns(task):
+    """
+    Returns
+    -------
+
+    check_fns : dict of str -> function
+        The checks configured for task
+
+    Raises
+    ------
+
+    ImportError:
+
+    if a check is not defined in checks.py
+    """
+
+    check_fns = get_check_fns()
+    task_check_fns = {}
+    for cur_check in parse_checks(task.checks):
+        if cur_check not in check_fns:
+            raise ImportError('Check {0} is not available.'.format(cur_check))
+        task_check_fns[cur_check] = check_fns[cur_check]
+
+    return task_check_fns
@@ -0,0 +1,286 @@
+"""
+Runs submission checks from checks.py in a persistent pool of worker
+processes, so that independent checks run at the same time and a runaway
+check can be killed after SUBMISSION_CHECK_TIMEOUT seconds without taking
+down the process serving the request.
+
+The pool is created lazily, once per process, with SUBMISSION_CHECK_PROCESSES
+workers, or as many as set with use_pool. It is shared by all threads of the
+process. Workers only run check functions and never use the database
+connections they inherit. With 0 processes, checks run one after the other
+in the calling process, without a timeout.
+
+Checks that write to the database (writes_db = True, see checks.py) always
+run in the calling process, so that their writes are part of the
+transaction of the submission and are rolled back with it.
+"""
+
+import cPickle as pickle
+import logging
+import select
+import time
+import traceback
+from Queue import Queue
+from multiprocessing import Pipe
+from multiprocessing import Process
+from threading import Lock
+
+from django.conf import settings
+from django.db import connections
+
+import check_registry
+
+logger = logging.getLogger(__name__)
+
+
+class CheckError(Exception):
+    """
+    A check raised an exception instead of returning its result.
+    """
+    pass
+
+
+class CheckResult(object):
+    def __init__(self, output, duration, timed_out=False):
+        # None if the check passed, error message otherwise
+        self.output = output
+        # Wall-clock time in seconds
+        self.duration = duration
+        self.timed_out = timed_out
+
+
+# Database connections inherited from the parent process. They must not be
+# used by a worker, and must not be closed either, as closing them would end
+# the parent's database session. Holding a reference keeps them from being
+# garbage collected.
+_inherited_connections = []
+
+
+def _check_kwargs(check_fn, kwargs, skeleton_loader):
+    if skeleton_loader is None or not getattr(check_fn, 'needs_skeleton', True):
+        return kwargs
+
+    load_fn, load_args = skeleton_loader
+    check_kwargs = dict(kwargs)
+    check_kwargs.update(load_fn(*load_args))
+
+    return check_kwargs
+
+
+def _serve(conn):
+    for db_conn in connections.all():
+        _inherited_connections.append(db_conn.connection)
+        db_conn.connection = None
+
+    while True:
+        check_name, kwargs_pickle, skeleton_loader = conn.recv()
+        kwargs = pickle.loads(kwargs_pickle)
+        start = time.time()
+        try:
+            # Resolved here, so that changes to checks.py reach the workers
+            check_fn = check_registry.get_check_fns()[check_name]
+            # Parsing here instead of in the parent keeps the skeleton from
+            # being pickled, and lets the checks parse in parallel.
+            output = check_fn(**_check_kwargs(check_fn, kwargs, skeleton_loader))
+            conn.send((True, output, time.time() - start))
+        except Exception:
+            conn.send((False, traceback.format_exc(), time.time() - start))
+
+
+class _Worker(object):
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_serve, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+class CheckExecutor(object):
+    def __init__(self, processes, timeout):
+        self.processes = processes
+        self.timeout = timeout
+        self.idle_workers = Queue()
+        for _ in range(processes):
+            self.idle_workers.put(_Worker())
+
+    def shutdown(self):
+        # Waits for the workers of runs in progress
+        for _ in range(self.processes):
+            self.idle_workers.get().kill()
+
+    def run(self, check_fns, kwargs, skeleton_loader=None):
+        """
+        Run check_fns (dict of check name -> check function) on kwargs in the
+        worker processes. See run_checks for skeleton_loader.
+
+        Returns
+        -------
+
+        results : dict of str -> CheckResult
+        """
+
+        kwargs_pickle = pickle.dumps(kwargs, pickle.HIGHEST_PROTOCOL)
+        pending = list(check_fns.keys())
+        busy = {}  # worker -> (check name, start time)
+        results = {}
+        error = None
+
+        while pending or busy:
+            # Block for a worker only if none is working for this run.
+            while pending and (not busy or not self.idle_workers.empty()):
+                worker = self.idle_workers.get()
+                name = pending.pop()
+                worker.conn.send((name, kwargs_pickle, skeleton_loader))
+                busy[worker] = (name, time.time())
+
+            next_deadline = min(x[1] for x in busy.values()) + self.timeout
+            ready, _, _ = select.select(
+                [x.conn for x in busy], [], [],
+                max(0., next_deadline - time.time()))
+
+            for worker in busy.keys():
+                name, start = busy[worker]
+                if worker.conn in ready:
+                    del busy[worker]
+                    try:
+                        success, output, duration = worker.conn.recv()
+                    except EOFError:
+                        # The worker process died
+                        worker.kill()
+                        worker = _Worker()
+                        success, output, duration = \
+                            False, 'Worker process died.', time.time() - start
+                    self.idle_workers.put(worker)
+                    if success:
+                        results[name] = CheckResult(output, duration)
+                    elif error is None:
+                        # Results of the other checks still have to be
+                        # collected, the workers could not be reused otherwise.
+                        error = CheckError(
+                            'Check {0} failed:\n{1}'.format(name, output))
+                elif time.time() - start >= self.timeout:
+                    del busy[worker]
+                    worker.kill()
+                    self.idle_workers.put(_Worker())
+                    results[name] = CheckResult(
+                        'The check {0} did not finish within {1} seconds. '
+                        'Please contact the admin team for '
+                        'assistance.'.format(name, self.timeout),
+                        time.time() - start, timed_out=True)
+
+        if error is not None:
+            raise error
+
+        for name, result in results.iteritems():
+            logger.info('Check %s took %.3f s%s', name, result.duration,
+                        ' (timed out)' if result.timed_out else '')
+
+        return results
+
+
+def _run_inline(check_fns, kwargs, skeleton_loader):
+    if skeleton_loader is not None and \
+            any(getattr(x, 'needs_skeleton', True) for x in check_fns.values()):
+        # Parse only once for all checks
+        load_fn, load_args = skeleton_loader
+        kwargs = dict(kwargs, **load_fn(*load_args))
+
+    results = {}
+    for name, check_fn in check_fns.iteritems():
+        start = time.time()
+        output = check_fn(**kwargs)
+        results[name] = CheckResult(output, time.time() - start)
+        logger.info('Check %s took %.3f s', name, results[name].duration)
+
+    return results
+
+
+_executor = None
+_executor_lock = Lock()
+# Size of the pool of this process, SUBMISSION_CHECK_PROCESSES if None
+_pool_processes = None
+
+
+def use_pool(processes):
+    """
+    Run the checks of this process in a pool of processes instead of
+    SUBMISSION_CHECK_PROCESSES. 0 runs them inline.
+    """
+
+    global _pool_processes
+
+    _pool_processes = processes
+
+
+def shutdown():
+    """
+    Stop the pool of this process, if any. It is created again by the next
+    run_checks.
+    """
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def run_checks(check_fns, kwargs, skeleton_loader=None):
+    """
+    Run check_fns (dict of check name -> check function) on kwargs, which
+    must be picklable.
+
+    skeleton_loader is a tuple (load_fn, args) of a module level function
+    and its arguments, load_fn(*args) returning additional keyword arguments
+    (the parsed skeleton) for the checks that need the skeleton, see
+    checks.py. It is called in the process that runs the check.
+
+    Returns
+    -------
+
+    results : dict of str -> CheckResult
+
+    Raises
+    ------
+
+    CheckError:
+
+    if a check raised an exception in a worker process. Checks that run
+    inline raise their exceptions directly.
+    """
+
+    global _executor
+
+    if not check_fns:
+        return {}
+
+    processes = _pool_processes
+    if processes is None:
+        processes = settings.SUBMISSION_CHECK_PROCESSES
+    if processes == 0:
+        return _run_inline(check_fns, kwargs, skeleton_loader)
+
+    inline_fns = dict((k, v) for k, v in check_fns.iteritems()
+                      if getattr(v, 'writes_db', False))
+    pool_fns = dict((k, v) for k, v in check_fns.iteritems()
+                    if k not in inline_fns)
+
+    results = {}
+    if pool_fns:
+        with _executor_lock:
+            if _executor is None:
+                _executor = CheckExecutor(processes,
+                                          settings.SUBMISSION_CHECK_TIMEOUT)
+        results.update(_executor.run(pool_fns, kwargs, skeleton_loader))
+
+    # After the pool checks, which may still raise
+    results.update(_run_inline(inline_fns, kwargs, skeleton_loader))
+
+    return results
@@ -19,22 +19,43 @@ Parameters:
 ----------
 
     skeleton: Skeleton object
-        skeleton that is analyzed
+        skeleton that is analyzed. None if no configured check
+        needs the graph, see needs_skeleton below.
+    annotation_header: dict
+        version, time and idle_time read from the <parameters>
+        block of the submission, see
+        aam_interaction.read_annotation_header
     work: Work object
         work connected to skeleton
     employee: Employee object
         Employee who is submitting this work
-    submit_file: file object
-        file can be parsed and read
+    submit_file: File object
+        carries the name of the submitted file, the contents
+        are in submit_file_as_string
+    submit_file_as_string: str
+        annotation.xml of the submission. None like skeleton.
     submit_is_final: boolean
         true for final submission
 
+Checks that only use annotation_header set needs_skeleton = False
+on the function, which allows submissions to skip building the
+full skeleton.
+
+Checks may run in parallel in separate processes (see
+check_runner.py), so they must not depend on each other, and keyword
+arguments they modify are not seen by the submission.
+
+Checks that write to the database set writes_db = True on the
+function. They always run in the process of the submission, inside
+its transaction.
+
 """
 
 __author__ = 'Fabian Svara'
 
 import knossos_utils.skeleton_utils as skel_utils
-from general_utilities.mailer import Mailer
+# Imported as module, as every function here is offered as a check
+from knossos_aam_backend import outbox
 
 
 class InvalidSubmission(Exception):
@@ -67,10 +88,10 @@ def automatic_worktime(**kwargs):
     # to unpack the keyword arguments
     #
 
-    skeleton = kwargs['skeleton']
+    annotation_header = kwargs['annotation_header']
     work = kwargs['work']
 
-    worktime = ((skeleton.getSkeletonTime() - skeleton.getIdleTime())
+    worktime = ((annotation_header['time'] - annotation_header['idle_time'])
                 / 1000.0 / 3600.0)
     if worktime < 0:
         worktime = 0.
@@ -83,6 +104,9 @@ def automatic_worktime(**kwargs):
     return incremental_worktime
 
 
+automatic_worktime.needs_skeleton = False
+
+
 def check_simple(**kwargs):
     """Checks if there is only one tree in the skeleton.
 
@@ -173,21 +197,13 @@ def email_on_submission(**kwargs):
 
     submit_file = kwargs['submit_file']
 
-    ma = Mailer('mail_host',
-                use_auth=True,
-                use_smtps=True,
-                smtp_user='smtp_user',
-                smtp_pass='smtp_pass',
-                port=465)
-    ma.open_session()
-
     subject = 'New {0} Submission Notification: {1} by {2}'.format(is_final_string, work.task.name, work.employee.user.username)
 
-    ma.send_mail('sender@example.com',
-                 ['recipient@example.com'],
-                 subject,
-                 'Subject',
-                 attachments=[(nml_string, submit_file.name)],
-                 reply_to=work.employee.user.email)
+    # Only queued here, the e-mail is sent by run_mail_sender.
+    outbox.enqueue_mail(subject,
+                        'Subject',
+                        attachments=[(nml_string, submit_file.name)],
+                        reply_to=work.employee.user.email)
+
 
-    ma.close_session()
+email_on_submission.writes_db = True
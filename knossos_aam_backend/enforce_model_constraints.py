@@ -4,11 +4,19 @@ respective models in models.py. Function names start with sender model name.
 """
 
 import os
-from inspect import getmembers
-from inspect import isfunction
+
+from django.db import transaction
+from django.db.models import BooleanField
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import Value
+from django.db.models import When
+from django.utils import timezone
 
 import models as mdl
+import task_file_cache
 from helpers import get_filefield_abspath
+from helpers import remove_orphaned_blob
 
 __author__ = 'Fabian Svara'
 
@@ -32,6 +40,21 @@ def task_ensure_valid_path(sender, instance, **kwargs):
         os.makedirs(abs_dir)
 
 
+def task_reset_file_hash(sender, instance, **kwargs):
+    # Recomputed when needed, see aam_interaction.task_file_etag
+    if not getattr(instance.task_file, '_committed', True):
+        # Newly uploaded
+        instance.task_file_sha256 = ''
+    elif instance.pk is not None:
+        old_name = mdl.Task.objects.filter(pk=instance.pk).values_list(
+            'task_file', flat=True).first()
+        if old_name != instance.task_file.name:
+            instance.task_file_sha256 = ''
+
+    if instance.pk is not None and not instance.task_file_sha256:
+        task_file_cache.invalidate(instance.pk)
+
+
 def submission_ensure_valid_path(sender, instance, **kwargs):
     abs_dir = os.path.dirname(get_filefield_abspath(instance.datafile))
     if not os.path.exists(abs_dir):
@@ -51,6 +74,16 @@ def submission_work_enforce_frozen(sender, instance, **kwargs):
         w._frozen = True
 
 
+def submission_store_monthly_worktime_values(sender, instance, **kwargs):
+    # The stored values, for submission_update_monthly_worktime to move an
+    # edited submission out of its old MonthlyWorktime row
+    instance._stored_monthly_worktime_values = None
+    if instance.pk is not None:
+        instance._stored_monthly_worktime_values = \
+            mdl.Submission.objects.filter(pk=instance.pk).values_list(
+                'employee_id', 'work__task_id', 'date', 'worktime').first()
+
+
 #
 # Post-save actions
 #
@@ -58,22 +91,50 @@ def submission_work_enforce_frozen(sender, instance, **kwargs):
 
 def task_validate_checks(sender, instance, created, **kwargs):
     if created:
-        from knossos_aam_backend import checks
-        available_checks_list = []
-        for x in [i for i in getmembers(checks) if isfunction(i[1])]:
-            available_checks_list.append(x[0])
-        user_checks_list = instance.checks.replace(',', ' ').split()
+        from knossos_aam_backend import check_registry
+        available_checks_list = check_registry.get_check_fns()
+        user_checks_list = check_registry.parse_checks(instance.checks)
         for cur_check in user_checks_list:
             if cur_check not in available_checks_list:
                 raise Exception('Check {0} is not available. Please try again.'.format(cur_check))
 
 
+def task_coverage_update(increment):
+    """
+    Keyword arguments for QuerySet.update() of Tasks that changes their
+    current_coverage by increment in the database, and is_active
+    accordingly. Conditions compare the coverage before the update.
+    """
+
+    if increment > 0:
+        # Deactivate once the target coverage is reached
+        is_active = Case(
+            When(current_coverage__gte=F('target_coverage') - increment,
+                 then=Value(False)),
+            default=F('is_active'),
+            output_field=BooleanField())
+    else:
+        # Reactivate once the coverage dropped below the target
+        is_active = Case(
+            When(current_coverage__lt=F('target_coverage') - increment,
+                 then=Value(True)),
+            default=F('is_active'),
+            output_field=BooleanField())
+
+    return {'current_coverage': F('current_coverage') + increment,
+            'is_active': is_active}
+
+
+def _task_update_coverage(task, increment):
+    # One UPDATE instead of read-modify-write, so that concurrent Work
+    # creations and deletions do not lose updates.
+    mdl.Task.objects.filter(pk=task.pk).update(**task_coverage_update(increment))
+    task.refresh_from_db(fields=['current_coverage', 'is_active'])
+
+
 def task_update_post_work_creation(sender, instance, created, **kwargs):
     if created:
-        instance.task.current_coverage += 1
-        if instance.task.current_coverage >= instance.task.target_coverage:
-            instance.task.is_active = False
-        instance.task.save()
+        _task_update_coverage(instance.task, 1)
 
 
 def work_update_post_submission(sender, instance, created, **kwargs):
@@ -83,6 +144,58 @@ def work_update_post_submission(sender, instance, created, **kwargs):
         instance.work.save()
 
 
+def _monthly_worktime_values(submission):
+    return (submission.employee_id, submission.work.task_id, submission.date,
+            submission.worktime)
+
+
+def _update_monthly_worktime(values, increment):
+    """
+    Add (increment 1) or remove (increment -1) a submission to or from its
+    MonthlyWorktime row, in the transaction of the save or delete.
+
+    Parameters
+    ----------
+
+    values : tuple
+        employee pk, task pk, date and worktime of the submission
+
+    increment : int
+    """
+
+    employee_id, task_id, date, worktime = values
+    date = timezone.localtime(date, timezone.get_default_timezone())
+    key = {'employee_id': employee_id,
+           'task_id': task_id,
+           'year': date.year,
+           'month': date.month, }
+
+    if increment > 0:
+        mdl.MonthlyWorktime.objects.get_or_create(**key)
+
+    mdl.MonthlyWorktime.objects.filter(**key).update(
+        worktime=F('worktime') + increment * (worktime or 0.),
+        submissions=F('submissions') + increment,
+        untimed_submissions=F('untimed_submissions') +
+                            increment * int(worktime is None))
+
+    if increment < 0:
+        mdl.MonthlyWorktime.objects.filter(submissions__lte=0, **key).delete()
+
+
+def submission_update_monthly_worktime(sender, instance, created, **kwargs):
+    values = _monthly_worktime_values(instance)
+    if created:
+        _update_monthly_worktime(values, 1)
+        return
+
+    # E.g. worktime, date, employee or work edited in the admin
+    stored_values = getattr(instance, '_stored_monthly_worktime_values', None)
+    if stored_values is not None and stored_values != values:
+        _update_monthly_worktime(stored_values, -1)
+        _update_monthly_worktime(values, 1)
+
+
 def task_category_name_without_dashes(sender, instance, created, **kwargs):
     if created:
         instance.name = instance.name.replace('-', '_')
@@ -106,13 +219,65 @@ def user_username_without_dashes(sender, instance, created, **kwargs):
         instance.save()
 
 
+#
+# Pre-delete actions
+#
+
+
+def submission_load_delta_dependents(sender, instance, **kwargs):
+    # For submission_store_dependents_in_full, together with the chain of
+    # deltas of instance, which is needed to rebuild them and may be deleted
+    # as well.
+    dependents = list(mdl.Submission.objects.filter(delta_base=instance))
+    if dependents:
+        cur_s = instance
+        while cur_s.delta_base_id is not None:
+            cur_s = cur_s.delta_base
+        for cur_s in dependents:
+            cur_s.delta_base = instance
+    instance._delta_dependents = dependents
+
+
+def submission_remove_monthly_worktime(sender, instance, **kwargs):
+    # Before the delete, when the Work of a cascade delete still exists
+    _update_monthly_worktime(_monthly_worktime_values(instance), -1)
+
+
 #
 # Post-delete actions
 #
 
 
+def task_invalidate_cached_file(sender, instance, **kwargs):
+    task_file_cache.invalidate(instance.pk)
+
+
 def task_update_post_work_deletion(sender, instance, **kwargs):
-    instance.task.current_coverage -= 1
-    if instance.task.current_coverage < instance.task.target_coverage:
-        instance.task.is_active = True
-    instance.task.save()
+    _task_update_coverage(instance.task, -1)
+
+
+def submission_store_dependents_in_full(sender, instance, **kwargs):
+    # After the delete, so that dependents deleted together with instance,
+    # e.g. with their Work, are not rebuilt in vain. Their files are only
+    # removed once the delete is committed.
+    from knossos_aam_backend import submission_deltas
+    dependents = getattr(instance, '_delta_dependents', [])
+    remaining = set(mdl.Submission.objects.filter(
+        pk__in=[x.pk for x in dependents]).values_list('pk', flat=True))
+    for cur_s in dependents:
+        if cur_s.pk in remaining:
+            submission_deltas.store_in_full(cur_s)
+
+
+def submission_remove_file(sender, instance, **kwargs):
+    # Only once the delete is committed, a rollback still needs the file.
+    # The blob goes with its last link.
+    path = instance.datafile.path if instance.datafile else None
+    sha256 = instance.sha256
+
+    def remove_file():
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+        remove_orphaned_blob(sha256)
+
+    transaction.on_commit(remove_file)
@@ -1,9 +1,185 @@
+import fcntl
+import hashlib
 import os
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
 
 from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+
+CHUNK_SIZE = 64 * 2 ** 10
 
 
 def get_filefield_abspath(filefield):
     pth = '{0}/{1}'.format(settings.MEDIA_ROOT, filefield.name)
 
     return os.path.normpath(pth)
+
+
+def ensure_dir(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+class SpooledFile(File):
+    """
+    A File that is already on disk in the spool and can be moved by
+    spool_upload, like uploads that Django streamed to a temporary file.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def link_spooled_file(path):
+    """
+    Hard link the file at path to a new file in SUBMISSION_SPOOL_DIR, or copy
+    it on filesystems without hard links, so that it can be moved by
+    spool_upload while path stays in place.
+
+    Returns the path of the new file.
+    """
+
+    ensure_dir(settings.SUBMISSION_SPOOL_DIR)
+    fd, link_path = tempfile.mkstemp(
+        suffix='.upload', dir=settings.SUBMISSION_SPOOL_DIR)
+    os.close(fd)
+    os.remove(link_path)
+    try:
+        os.link(path, link_path)
+    except OSError:
+        shutil.copyfile(path, link_path)
+
+    return link_path
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def spool_upload(uploaded_file):
+    """
+    Write an uploaded file to a new file in SUBMISSION_SPOOL_DIR, chunk by
+    chunk, so that it is never held in memory as a whole. Uploads that Django
+    already streamed to a temporary file are moved instead of copied.
+
+    Returns the path of the spooled file and the SHA-256 hex digest of its
+    contents.
+    """
+
+    ensure_dir(settings.SUBMISSION_SPOOL_DIR)
+    fd, spool_path = tempfile.mkstemp(
+        suffix='.upload', dir=settings.SUBMISSION_SPOOL_DIR)
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        os.close(fd)
+        file_move_safe(uploaded_file.temporary_file_path(), spool_path,
+                       allow_overwrite=True)
+        sha256 = hash_file(spool_path)
+    else:
+        sha256 = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as fp:
+            for chunk in uploaded_file.chunks():
+                sha256.update(chunk)
+                fp.write(chunk)
+        sha256 = sha256.hexdigest()
+
+    return spool_path, sha256
+
+
+def get_blob_path(sha256):
+    return os.path.join(settings.SUBMISSION_BLOB_DIR, sha256[0:2], sha256)
+
+
+@contextmanager
+def blob_lock():
+    """
+    Exclusive lock on SUBMISSION_BLOB_DIR across processes. Blobs are removed
+    once nothing links to them anymore, so checking the links of a blob and
+    adding or removing one must not interleave.
+    """
+
+    ensure_dir(settings.SUBMISSION_BLOB_DIR)
+    with open(os.path.join(settings.SUBMISSION_BLOB_DIR, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store_blob(path, sha256, link_path):
+    """
+    Move the file at path into the content-addressed SUBMISSION_BLOB_DIR,
+    unless a file with the same contents is stored there already, and hard
+    link link_path to the blob. If the blob existed, the file at path is
+    left alone. On filesystems without hard links, link_path is a copy.
+    """
+
+    blob_path = get_blob_path(sha256)
+    with blob_lock():
+        if not os.path.exists(blob_path):
+            ensure_dir(os.path.dirname(blob_path))
+            file_move_safe(path, blob_path)
+
+        try:
+            os.link(blob_path, link_path)
+        except OSError:
+            shutil.copyfile(blob_path, link_path)
+
+
+def remove_orphaned_blob(sha256):
+    """
+    Remove the blob of sha256 if no submission file links to it anymore.
+    """
+
+    if not sha256:
+        return
+
+    blob_path = get_blob_path(sha256)
+    with blob_lock():
+        if os.path.exists(blob_path) and os.stat(blob_path).st_nlink == 1:
+            os.remove(blob_path)
+
+
+def check_kzip(path):
+    """
+    Raise if the k.zip at path is no zip file or has no annotation.xml.
+    """
+
+    with zipfile.ZipFile(path, 'r') as zipper:
+        if 'annotation.xml' not in zipper.namelist():
+            raise Exception('k.zip broken.')
+
+
+@contextmanager
+def open_annotation(path, is_zip):
+    """
+    Open the annotation.xml of the k.zip at path as a decompressing stream.
+    If is_zip is False, path is taken to be a plain nml file.
+    """
+
+    if not is_zip:
+        with open(path, 'rb') as fp:
+            yield fp
+        return
+
+    zipper = zipfile.ZipFile(path, 'r')
+    try:
+        if 'annotation.xml' not in zipper.namelist():
+            raise Exception('k.zip broken.')
+        fp = zipper.open('annotation.xml')
+        try:
+            yield fp
+        finally:
+            fp.close()
+    finally:
+        zipper.close()
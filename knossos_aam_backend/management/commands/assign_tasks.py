@@ -0,0 +1,76 @@
+"""
+Bulk assignment of tasks to employees, e.g. to staff a new category. Either
+distribute the active tasks of a category over a team in turn:
+
+knossos-aam assign_tasks --employees alice bob carol --project P --category C
+
+or assign explicit pairs from a csv file with lines "username,task id":
+
+knossos-aam assign_tasks --pairs assignments.csv
+"""
+
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend.models import Employee, Task
+
+
+def employee_pks_by_username(usernames):
+    employee_pks = dict(Employee.objects.filter(
+        user__username__in=usernames).values_list('user__username', 'pk'))
+    missing = set(usernames) - set(employee_pks.keys())
+    if missing:
+        raise CommandError('Unknown users: {0}'.format(', '.join(sorted(missing))))
+
+    return employee_pks
+
+
+class Command(BaseCommand):
+    help = 'Assign many tasks to employees at once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', nargs='+', default=[],
+                            help='Usernames to distribute the tasks over.')
+        parser.add_argument('--project', default=None)
+        parser.add_argument('--category', default=None)
+        parser.add_argument('--pairs', default=None,
+                            help='csv file with lines "username,task id".')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only print the number of assignments.')
+
+    def handle(self, *args, **options):
+        if options['pairs']:
+            with open(options['pairs']) as fp:
+                rows = [x for x in csv.reader(fp) if x]
+            employee_pks = employee_pks_by_username(set(x[0] for x in rows))
+            assignments = [(employee_pks[x[0]], int(x[1])) for x in rows]
+        elif options['employees'] and options['project'] and options['category']:
+            employee_pks = employee_pks_by_username(options['employees'])
+            task_pks = list(Task.objects.filter(
+                category__project__name=options['project'],
+                category__name=options['category'],
+                is_active=True).order_by('-priority', 'pk').values_list(
+                'pk', flat=True))
+            assignments = aam_interaction.round_robin_assignment(
+                [employee_pks[x] for x in options['employees']], task_pks)
+        else:
+            raise CommandError('Either --pairs or --employees, --project and '
+                               '--category are required.')
+
+        if options['dry_run']:
+            self.stdout.write('{0} assignments.'.format(len(assignments)))
+            return
+
+        try:
+            count, skipped = aam_interaction.bulk_assign_tasks(assignments)
+        except aam_interaction.InvalidAssignment, e:
+            raise CommandError(str(e))
+
+        usernames = dict(Employee.objects.filter(
+            pk__in=set(x[0] for x in skipped)).values_list('pk', 'user__username'))
+        for employee_pk, task_pk, reason in skipped:
+            self.stdout.write('Skipped {0}, task {1}: {2}'.format(
+                usernames[employee_pk], task_pk, reason))
+        self.stdout.write('Created {0} works.'.format(count))
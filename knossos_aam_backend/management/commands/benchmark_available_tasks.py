@@ -0,0 +1,114 @@
+"""
+Benchmark for finding available tasks. Fills a freshly created test
+database with growing numbers of tasks and measures get_available_tasks (as
+used by the home view) and get_best_available_task (the same ranking as
+claim_task uses for api/2/new_task). Latency should stay flat as the task
+count grows:
+
+knossos-aam benchmark_available_tasks --tasks 1000 10000 100000
+"""
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend.models import Employee, Project, Task, TaskCategory, Work
+
+BATCH_SIZE = 5000
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _add_tasks(categories, employee, count, first_id):
+    """
+    Add count tasks spread over categories, and let employee have worked on
+    every tenth of them.
+    """
+
+    rnd = random.Random(first_id)
+    for start in range(first_id, first_id + count, BATCH_SIZE):
+        tasks = []
+        for i in range(start, min(first_id + count, start + BATCH_SIZE)):
+            category = categories[i % len(categories)]
+            name = 'task_{0}'.format(i)
+            # bulk_create does not send pre_save, which sets
+            # category_name_combination
+            tasks.append(Task(
+                category=category,
+                name=name,
+                category_name_combination='{0}_{1}'.format(category.name, name),
+                priority=rnd.randint(-1, 10),
+                is_active=rnd.random() > 0.2,
+                target_coverage=3))
+        Task.objects.bulk_create(tasks)
+
+    done = Task.objects.filter(
+        name__in=['task_{0}'.format(i)
+                  for i in range(first_id, first_id + count, 10)])
+    Work.objects.bulk_create([
+        Work(started=timezone.now(), task=t, employee=employee, is_final=True)
+        for t in done])
+
+
+class Command(BaseCommand):
+    help = 'Benchmark get_available_tasks with growing numbers of tasks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, nargs='+',
+                            default=[1000, 10000, 100000])
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--count', type=int, default=1,
+                            help='Tasks per category for get_available_tasks.')
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True)
+
+        try:
+            User.objects.create_user('benchmark')
+            project = Project.objects.create(name='benchmark', description='')
+            employee = Employee.objects.get(user__username='benchmark')
+            employee.project = project
+            employee.save()
+            categories = [TaskCategory.objects.create(
+                name='category_{0}'.format(i), project=project, description='')
+                for i in range(options['categories'])]
+
+            self.stdout.write('tasks\tfunction\tp50 [ms]\tp90 [ms]\tqueries')
+            n_tasks = 0
+            for total in sorted(options['tasks']):
+                _add_tasks(categories, employee, total - n_tasks, n_tasks)
+                n_tasks = total
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+
+                for name, fn in [
+                        ('get_available_tasks', lambda: aam_interaction.get_available_tasks(
+                            employee, options['count'])),
+                        ('get_best_available_task', lambda: aam_interaction.get_best_available_task(
+                            employee)), ]:
+                    latencies = []
+                    for _ in range(options['repeat']):
+                        with CaptureQueriesContext(connection) as ctx:
+                            start = time.time()
+                            fn()
+                            latencies.append(time.time() - start)
+                    self.stdout.write('{0}\t{1}\t{2:.2f}\t{3:.2f}\t{4}'.format(
+                        total, name, 1000. * _percentile(latencies, 0.5),
+                        1000. * _percentile(latencies, 0.9),
+                        len(ctx.captured_queries)))
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            teardown_test_environment()
@@ -0,0 +1,254 @@
+"""
+Benchmark for submission ingestion. Submits synthetic tracings of different
+sizes, with different combinations of checks, directly through
+aam_interaction.submit and through the submit API view, against a freshly
+created test database:
+
+knossos-aam benchmark_submit --nodes 1000 100000 --save-baseline base.json
+knossos-aam benchmark_submit --nodes 1000 100000 --compare base.json
+
+Every case runs in its own process, so that its peak RSS can be reported.
+Checks run in the check processes of that process, as in the server
+processes (see check_runner.py). They are stopped before the peak RSS is
+taken, so that it includes them.
+"""
+
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend import check_runner
+from knossos_aam_backend.helpers import SpooledFile
+from knossos_aam_backend.models import Employee, Project, Task, TaskCategory, Work
+from knossos_aam_utils.synthetic_tracings import write_synthetic_kzip
+
+DEFAULT_CHECKS = [
+    '',
+    'automatic_worktime',
+    'automatic_worktime check_simple',
+    'automatic_worktime check_simple check_connected_component',
+]
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * resource.getpagesize() / 2. ** 20
+
+
+def _create_work(checks, case_id):
+    project = Project.objects.get_or_create(
+        name='benchmark', defaults={'description': 'benchmark'})[0]
+    category = TaskCategory.objects.get_or_create(
+        name='benchmark', project=project, defaults={'description': ''})[0]
+    task = Task.objects.create(
+        category=category, name='case_{0}'.format(case_id), checks=checks,
+        target_coverage=1, task_file='')
+    employee = Employee.objects.get(user__username=USERNAME)
+    employee.project = project
+    employee.save()
+
+    # Only one active work is allowed per employee
+    Work.objects.filter(employee=employee, is_final=False).update(is_final=True)
+
+    return Work.objects.create(started=timezone.now(), task=task,
+                               employee=employee, is_final=False)
+
+
+def _submit_direct(kzip_path, work, tmp_dir):
+    # Like an upload that Django streamed to a temporary file
+    upload_path = os.path.join(tmp_dir, 'upload.k.zip')
+    shutil.copyfile(kzip_path, upload_path)
+    with open(upload_path, 'rb') as fp:
+        aam_interaction.submit(work.employee, SpooledFile(fp, name='benchmark.k.zip'),
+                               '', False, work.pk)
+
+
+def _submit_client(kzip_path, client):
+    with open(kzip_path, 'rb') as fp:
+        r = client.post('/api/2/submit', {'submit_work_file': fp})
+    if r.status_code != 201:
+        raise CommandError('Submission failed: {0}'.format(r.content))
+
+
+def _run_case(case, kzip_path, repeat, case_id, queue):
+    try:
+        tmp_dir = tempfile.mkdtemp()
+        work = _create_work(case['checks'], case_id)
+        client = Client()
+        client.login(username=USERNAME, password=PASSWORD)
+
+        latencies = []
+        queries = []
+        rss_start = _rss_mb()
+        # The first submission imports the checks and is not counted
+        for i in range(repeat + 1):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.time()
+                if case['mode'] == 'direct':
+                    _submit_direct(kzip_path, work, tmp_dir)
+                else:
+                    _submit_client(kzip_path, client)
+                duration = time.time() - start
+            if i > 0:
+                latencies.append(duration)
+                queries.append(len(ctx.captured_queries))
+
+        shutil.rmtree(tmp_dir)
+        # Reaps the check processes, for RUSAGE_CHILDREN
+        check_runner.shutdown()
+
+        result = dict(case)
+        result.update({
+            'p50_ms': 1000. * _percentile(latencies, 0.5),
+            'p90_ms': 1000. * _percentile(latencies, 0.9),
+            'p99_ms': 1000. * _percentile(latencies, 0.99),
+            # Including the check processes
+            'peak_rss_mb': max(
+                resource.getrusage(x).ru_maxrss for x in
+                (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024.,
+            'rss_growth_mb': _rss_mb() - rss_start,
+            'queries': max(queries), })
+        queue.put(result)
+    except Exception, e:
+        queue.put({'error': str(e)})
+
+
+def _case_key(case):
+    return '{mode}|{nodes}|{trees}|{checks}'.format(**case)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark submission ingestion with synthetic tracings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, nargs='+',
+                            default=[1000, 10000, 100000, 1000000])
+        parser.add_argument('--trees', type=int, nargs='+', default=[1])
+        parser.add_argument('--checks', nargs='+', default=DEFAULT_CHECKS,
+                            help='Check combinations, each as one string of '
+                                 'check names separated by spaces.')
+        parser.add_argument('--modes', nargs='+', default=['direct', 'client'],
+                            choices=['direct', 'client'])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--save-baseline', default=None,
+                            help='Write the results to this json file.')
+        parser.add_argument('--compare', default=None,
+                            help='Compare the results to this json baseline.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Relative latency increase over the '
+                                 'baseline that counts as a regression.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True)
+        media_root = tempfile.mkdtemp()
+
+        try:
+            with override_settings(
+                    MEDIA_ROOT=media_root,
+                    SUBMISSION_SPOOL_DIR=os.path.join(media_root, 'spool'),
+                    SUBMISSION_BLOB_DIR=os.path.join(media_root, 'blobs')):
+                User.objects.create_user(USERNAME, password=PASSWORD)
+                results = self.run_cases(options, media_root)
+        finally:
+            shutil.rmtree(media_root)
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            teardown_test_environment()
+
+        self.print_results(results)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as fp:
+                json.dump(results, fp, indent=4)
+
+        if options['compare']:
+            with open(options['compare']) as fp:
+                baseline = json.load(fp)
+            if self.compare(results, baseline, options['tolerance']):
+                raise CommandError('Regressions found.')
+
+    def run_cases(self, options, media_root):
+        results = []
+        case_id = 0
+        for nodes in options['nodes']:
+            for trees in options['trees']:
+                kzip_path = write_synthetic_kzip(
+                    os.path.join(media_root, 'synthetic.k.zip'), nodes, trees)
+                for checks in options['checks']:
+                    for mode in options['modes']:
+                        case = {'mode': mode, 'nodes': nodes, 'trees': trees,
+                                'checks': checks}
+                        case_id += 1
+
+                        # Forked processes must open their own database
+                        # connections.
+                        connections.close_all()
+                        queue = Queue()
+                        p = Process(target=_run_case, args=(
+                            case, kzip_path, options['repeat'], case_id, queue))
+                        p.start()
+                        result = queue.get()
+                        p.join()
+
+                        if 'error' in result:
+                            raise CommandError('{0} failed: {1}'.format(
+                                _case_key(case), result['error']))
+                        results.append(result)
+                        self.stdout.write('{0}: {1:.1f} ms'.format(
+                            _case_key(case), result['p50_ms']))
+
+        return results
+
+    def print_results(self, results):
+        self.stdout.write('\nmode\tnodes\ttrees\tp50 [ms]\tp90 [ms]\tp99 [ms]\t'
+                          'peak RSS [MB]\tqueries\tchecks')
+        for r in results:
+            self.stdout.write(
+                '{mode}\t{nodes}\t{trees}\t{p50_ms:.1f}\t{p90_ms:.1f}\t'
+                '{p99_ms:.1f}\t{peak_rss_mb:.1f}\t{queries}\t{checks}'.format(**r))
+
+    def compare(self, results, baseline, tolerance):
+        """
+        Print the cases that got slower or need more queries than in
+        baseline. Returns True if there are any.
+        """
+
+        baseline = dict((_case_key(x), x) for x in baseline)
+        regressions = False
+        for r in results:
+            b = baseline.get(_case_key(r))
+            if b is None:
+                continue
+            if r['p50_ms'] > b['p50_ms'] * (1. + tolerance) \
+                    or r['queries'] > b['queries']:
+                regressions = True
+                self.stdout.write(
+                    'REGRESSION {0}: {1:.1f} ms ({2:.1f} ms), {3} queries '
+                    '({4} queries)'.format(_case_key(r), r['p50_ms'],
+                                           b['p50_ms'], r['queries'],
+                                           b['queries']))
+
+        return regressions
@@ -0,0 +1,129 @@
+"""
+Query count check for get_monthly_worktime_for_submissions and for the time
+overviews. Creates submission histories of growing length and monthly
+worktimes of a growing number of employees in a freshly created test
+database and verifies that the number of queries depends on neither:
+
+knossos-aam check_worktime_queries --lengths 10 1000 100000 --employees 10 5000
+"""
+
+import datetime
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend.models import Employee, MonthlyWorktime, Project, \
+    Submission, Task, TaskCategory, Work
+
+
+class Command(BaseCommand):
+    help = 'Check that the monthly worktime takes a constant number of queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lengths', type=int, nargs='+',
+                            default=[10, 1000, 10000])
+        parser.add_argument('--tasks', type=int, default=20)
+        parser.add_argument('--employees', type=int, nargs='+',
+                            default=[10, 100, 1000])
+        parser.add_argument('--months', type=int, default=12)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True)
+
+        try:
+            self.check_queries(options)
+            self.check_overview_queries(options)
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            teardown_test_environment()
+
+    def check_queries(self, options):
+        project = Project.objects.create(name='worktime', description='')
+        category = TaskCategory.objects.create(
+            name='worktime', project=project, description='')
+        tasks = [Task.objects.create(category=category, name='task_{0}'.format(i),
+                                     task_file='')
+                 for i in range(options['tasks'])]
+        start_date = timezone.now() - datetime.timedelta(days=3 * 365)
+
+        query_counts = []
+        for length in options['lengths']:
+            user = User.objects.create_user('worktime_{0}'.format(length))
+            employee = Employee.objects.get(user=user)
+            works = [Work.objects.create(task=x, employee=employee) for x in tasks]
+            Submission.objects.bulk_create([
+                Submission(employee=employee,
+                           work=works[i % len(works)],
+                           date=start_date + datetime.timedelta(hours=i),
+                           original_filename='worktime.k.zip',
+                           datafile='worktime.k.zip',
+                           # Some submissions without automatic worktime
+                           worktime=None if i % 97 == 0 else 1.)
+                for i in range(length)], batch_size=1000)
+
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                overview = aam_interaction.get_monthly_worktime_for_submissions(
+                    Submission.objects.filter(employee=employee))
+                duration = time.time() - start
+
+            n_months = sum(len(x) for x in overview['by_month_totals'].values())
+            self.stdout.write('{0} submissions, {1} months: {2} queries in '
+                              '{3:.3f} s.'.format(length, n_months,
+                                                  len(queries), duration))
+            query_counts.append(len(queries))
+
+        if len(set(query_counts)) != 1:
+            raise CommandError('The number of queries depends on the number '
+                               'of submissions: {0}'.format(query_counts))
+        self.stdout.write('Constant number of queries.')
+
+    def check_overview_queries(self, options):
+        project = Project.objects.get(name='worktime')
+        tasks = list(Task.objects.filter(category__project=project))
+
+        query_counts = []
+        n_created = 0
+        for n_employees in sorted(options['employees']):
+            MonthlyWorktime.objects.all().delete()
+            for i in range(n_created, n_employees):
+                User.objects.create_user('overview_{0}'.format(i))
+            n_created = max(n_created, n_employees)
+            Employee.objects.update(project=project)
+            employee_pks = list(Employee.objects.values_list(
+                'pk', flat=True)[:n_employees])
+
+            MonthlyWorktime.objects.bulk_create([
+                MonthlyWorktime(employee_id=x,
+                                task=tasks[(x + m) % len(tasks)],
+                                year=2017 + m // 12,
+                                month=m % 12 + 1,
+                                worktime=1.,
+                                submissions=1)
+                for x in employee_pks
+                for m in range(options['months'])], batch_size=1000)
+
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                aam_interaction.get_monthly_worktime_by_employee(
+                    MonthlyWorktime.objects.all())
+                aam_interaction.get_monthly_worktime_by_project(
+                    MonthlyWorktime.objects.filter(year=2017, month=1))
+                duration = time.time() - start
+
+            self.stdout.write('{0} employees: {1} queries in {2:.3f} s.'.format(
+                n_employees, len(queries), duration))
+            query_counts.append(len(queries))
+
+        if len(set(query_counts)) != 1:
+            raise CommandError('The number of queries depends on the number '
+                               'of employees: {0}'.format(query_counts))
+        self.stdout.write('Constant number of queries for the overviews.')
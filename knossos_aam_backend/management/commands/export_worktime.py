@@ -0,0 +1,43 @@
+"""
+Export the monthly worktime per employee and task, e.g. for payroll, see
+worktime_export.py:
+
+knossos-aam export_worktime --format csv --start 2017-01 --end 2017-12 --output 2017.csv
+"""
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend import worktime_export
+
+
+class Command(BaseCommand):
+    help = 'Export the monthly worktime per employee and task.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default='csv',
+                            choices=sorted(worktime_export.CONTENT_TYPES))
+        parser.add_argument('--start', default=None,
+                            help='First month as YYYY-MM.')
+        parser.add_argument('--end', default=None,
+                            help='Last month as YYYY-MM.')
+        parser.add_argument('--output', default=None,
+                            help='Output file, standard output if not given.')
+
+    def handle(self, *args, **options):
+        try:
+            start, end = [aam_interaction.parse_month(options[x]) if options[x]
+                          else None for x in ('start', 'end')]
+        except ValueError:
+            raise CommandError('--start and --end must be given as YYYY-MM.')
+
+        out = sys.stdout if options['output'] is None \
+            else open(options['output'], 'wb')
+        try:
+            for chunk in worktime_export.export(options['format'], start, end):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
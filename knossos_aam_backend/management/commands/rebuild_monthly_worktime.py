@@ -0,0 +1,22 @@
+"""
+Rebuild the monthly worktime rollup read by the time overviews from all
+submissions, e.g. after upgrading an existing installation:
+
+knossos-aam rebuild_monthly_worktime
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from knossos_aam_backend import aam_interaction
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the monthly worktime rollup from the submissions.'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = aam_interaction.rebuild_monthly_worktime()
+        self.stdout.write('Rebuilt {0} monthly worktimes in {1:.1f} s.'.format(
+            count, time.time() - start))
@@ -0,0 +1,34 @@
+"""
+Background sender for queued e-mail notifications, see outbox.py:
+
+knossos-aam run_mail_sender
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from knossos_aam_backend.outbox import MailSender
+
+
+class Command(BaseCommand):
+    help = 'Send queued e-mail notifications.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5.,
+                            help='Seconds to wait when no message is pending.')
+        parser.add_argument('--idle-timeout', type=float, default=60.,
+                            help='Seconds after which an unused SMTP session '
+                                 'is closed.')
+
+    def handle(self, *args, **options):
+        sender = MailSender()
+        try:
+            while True:
+                if not sender.send_pending():
+                    sender.close_if_idle(options['idle_timeout'])
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sender.close()
@@ -0,0 +1,67 @@
+"""
+Local worker pool for asynchronous submission checks. Workers poll the
+SubmissionJob table, so no message broker is needed:
+
+knossos-aam run_submission_worker --processes 4
+"""
+
+import time
+from multiprocessing import Process
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend import check_runner
+
+
+def work_loop(poll_interval, check_processes):
+    check_runner.use_pool(check_processes)
+    while True:
+        if not aam_interaction.process_next_submission_job():
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = 'Run the checks of submissions that were submitted asynchronously.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Number of worker processes.')
+        parser.add_argument('--poll-interval', type=float, default=1.,
+                            help='Seconds to wait when no job is pending.')
+        parser.add_argument('--check-processes', type=int,
+                            default=settings.SUBMISSION_CHECK_PROCESSES,
+                            help='Check processes of each worker, 0 runs '
+                                 'the checks in the worker itself.')
+
+    def start_worker(self, poll_interval, check_processes):
+        # Forked workers must not share the database connection of the
+        # parent process.
+        connections.close_all()
+        # Not daemonic, as workers start their own check processes
+        # (see check_runner.py).
+        w = Process(target=work_loop, args=(poll_interval, check_processes))
+        w.start()
+        return w
+
+    def handle(self, *args, **options):
+        poll_interval = options['poll_interval']
+        check_processes = options['check_processes']
+        workers = [self.start_worker(poll_interval, check_processes)
+                   for _ in range(options['processes'])]
+        self.stdout.write('Started {0} submission workers.'.format(len(workers)))
+
+        try:
+            while True:
+                for i, w in enumerate(workers):
+                    if not w.is_alive():
+                        self.stderr.write('Submission worker {0} exited with code {1}, '
+                                          'restarting.'.format(w.pid, w.exitcode))
+                        workers[i] = self.start_worker(poll_interval,
+                                                       check_processes)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            for w in workers:
+                w.terminate()
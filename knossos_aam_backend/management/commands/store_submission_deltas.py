@@ -0,0 +1,77 @@
+"""
+Convert the submissions of existing works to delta storage (see
+submission_deltas.py), and optionally measure how long rebuilding them takes:
+
+knossos-aam store_submission_deltas --benchmark
+"""
+
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from knossos_aam_backend import submission_deltas
+from knossos_aam_backend.models import Work
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Command(BaseCommand):
+    help = 'Store all but the last submission of each work as deltas.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--work', type=int, nargs='*', default=None,
+                            help='Only convert the works with these ids.')
+        parser.add_argument('--benchmark', action='store_true',
+                            help='Measure rebuilding every delta-stored '
+                                 'submission of the converted works.')
+
+    def handle(self, *args, **options):
+        works = Work.objects.all()
+        if options['work']:
+            works = works.filter(pk__in=options['work'])
+
+        size_before = 0
+        size_after = 0
+        for w in works.iterator():
+            submissions = list(w.submission_set.order_by('date', 'pk'))
+            # Oldest first, so that the base of each delta is still stored
+            # in full.
+            for s, base in zip(submissions, submissions[1:]):
+                if s.delta_base_id is not None or base.delta_base_id is not None:
+                    continue
+                size = os.path.getsize(s.datafile.path)
+                if submission_deltas.store_as_delta(s, base):
+                    size_before += size
+                    size_after += os.path.getsize(s.datafile.path)
+
+        self.stdout.write('Converted {0} bytes to {1} bytes of deltas.'.format(
+            size_before, size_after))
+
+        if not options['benchmark']:
+            return
+
+        # Rebuild latency by length of the delta chain
+        latencies = {}
+        for w in works.iterator():
+            submissions = list(w.submission_set.order_by('-date', '-pk'))
+            depth = 0
+            for s in submissions:
+                if s.delta_base_id is None:
+                    depth = 0
+                    continue
+                depth += 1
+                start = time.time()
+                with submission_deltas.full_submission_file(s):
+                    pass
+                latencies.setdefault(depth, []).append(time.time() - start)
+
+        self.stdout.write('depth\tcount\tmedian [ms]\tp95 [ms]\tmax [ms]')
+        for depth in sorted(latencies):
+            values = latencies[depth]
+            self.stdout.write('{0}\t{1}\t{2:.1f}\t{3:.1f}\t{4:.1f}'.format(
+                depth, len(values), 1000. * _percentile(values, 0.5),
+                1000. * _percentile(values, 0.95), 1000. * max(values)))
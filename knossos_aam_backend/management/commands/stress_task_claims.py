@@ -0,0 +1,96 @@
+"""
+Concurrency check for claim_task, the claim path of api/2/new_task. Fires
+claims of many employees at the same time against a freshly created test
+database and verifies that no task is handed out more often than its target
+coverage and that current_coverage matches the created Works:
+
+knossos-aam stress_task_claims --employees 500 --tasks 100 --processes 32
+"""
+
+import time
+from multiprocessing import Pool
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from knossos_aam_backend import aam_interaction
+from knossos_aam_backend.models import Employee, Project, Task, TaskCategory
+
+
+def _claim(employee_pk):
+    employee = Employee.objects.get(pk=employee_pk)
+    task = aam_interaction.claim_task(employee)
+    return None if task is None else task.pk
+
+
+class Command(BaseCommand):
+    help = 'Check that concurrent task claims keep the task coverage exact.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=500)
+        parser.add_argument('--tasks', type=int, default=100)
+        parser.add_argument('--target-coverage', type=int, default=3)
+        parser.add_argument('--processes', type=int, default=32)
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_db_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True)
+
+        try:
+            self.check_claims(options)
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity=0)
+            teardown_test_environment()
+
+    def check_claims(self, options):
+        project = Project.objects.create(name='stress', description='')
+        category = TaskCategory.objects.create(
+            name='stress', project=project, description='')
+        for i in range(options['tasks']):
+            Task.objects.create(category=category, name='task_{0}'.format(i),
+                                target_coverage=options['target_coverage'],
+                                task_file='')
+        for i in range(options['employees']):
+            User.objects.create_user('stress_{0}'.format(i))
+        Employee.objects.update(project=project)
+        employee_pks = list(Employee.objects.values_list('pk', flat=True))
+
+        # Forked workers must open their own database connections
+        connections.close_all()
+        pool = Pool(options['processes'])
+        start = time.time()
+        try:
+            claimed = pool.map(_claim, employee_pks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        duration = time.time() - start
+
+        capacity = options['tasks'] * options['target_coverage']
+        n_claimed = len([x for x in claimed if x is not None])
+        self.stdout.write('{0} of {1} claims succeeded in {2:.2f} s, capacity '
+                          '{3}.'.format(n_claimed, len(claimed), duration,
+                                        capacity))
+
+        errors = []
+        if n_claimed != min(capacity, len(employee_pks)):
+            errors.append('Expected {0} successful claims, got {1}.'.format(
+                min(capacity, len(employee_pks)), n_claimed))
+        for t in Task.objects.annotate(n_works=Count('work')):
+            if t.current_coverage != t.n_works:
+                errors.append('{0}: current_coverage {1}, but {2} works.'.format(
+                    t.name, t.current_coverage, t.n_works))
+            if t.n_works > t.target_coverage:
+                errors.append('{0}: {1} works, target coverage {2}.'.format(
+                    t.name, t.n_works, t.target_coverage))
+            if t.is_active != (t.n_works < t.target_coverage):
+                errors.append('{0}: is_active {1} with {2} works.'.format(
+                    t.name, t.is_active, t.n_works))
+
+        if errors:
+            raise CommandError('\n'.join(errors))
+        self.stdout.write('Coverage is exact.')
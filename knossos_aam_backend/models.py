@@ -1,12 +1,12 @@
-from inspect import getmembers, isfunction
-
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
+from django.utils import timezone
 from django.utils.text import get_valid_filename
 
-import checks
+import check_registry
 import enforce_model_constraints as emc
+import task_dispatcher
 
 __author__ = 'Fabian Svara'
 
@@ -105,17 +105,21 @@ class Task(models.Model):
     # In days.
     freeze_delay = models.FloatField(default=0., blank=False, null=False)
     task_file = models.FileField(default=False, upload_to=task_filename, null=True, blank=True)
+    # SHA-256 of task_file, used as ETag. Computed when first needed, see
+    # aam_interaction.task_file_etag.
+    task_file_sha256 = models.CharField(max_length=64, blank=True)
 
     def checks_available():
         # Checks are functions that can run on a submission to ensure that it
         # fulfills certain criteria.
-        checks_list = []
-        for x in [i for i in getmembers(checks) if isfunction(i[1])]:
-            checks_list.append(x[0])
-        return ' '.join(checks_list)
+        return ' '.join(check_registry.available_checks())
 
     checks = models.CharField(max_length=400, blank=True, help_text=checks_available())
 
+    class Meta:
+        # Ranking of available tasks, see aam_interaction.get_available_tasks
+        index_together = [('category', 'is_active', 'priority'), ]
+
     def latest_submissions(self):
         return [xx.last_submission for xx in self.work_set.all()
                 if xx.last_submission is not None]
@@ -180,7 +184,7 @@ class Submission(models.Model):
     original_filename = models.CharField(max_length=200)
 
     # The following fields are automatically extracted
-    # Work time in milliseconds
+    # Work time in hours
     # Null / None worktime means the work time was not
     # extracted automatically and should be set manually.
     worktime = models.FloatField(default=0, null=True, blank=True)
@@ -189,6 +193,14 @@ class Submission(models.Model):
         return str(self.worktime)
 
     datafile = models.FileField(upload_to=submission_filename, max_length=400)
+    # SHA-256 of datafile, which is a hard link to the blob of that name.
+    # Empty for submissions stored before deduplication.
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    # If set, datafile holds a delta against the datafile of delta_base,
+    # see submission_deltas.py.
+    delta_base = models.ForeignKey(
+        'self', blank=True, null=True, default=None,
+        related_name='delta_dependents', on_delete=models.SET_NULL)
 
     def __unicode__(self):
         submissiontype = "Submission:"
@@ -204,9 +216,181 @@ class Submission(models.Model):
             str(self.date), ])
 
 
+class MonthlyWorktime(models.Model):
+    """
+    Rollup of the submissions of an employee on a task in one month, in
+    TIME_ZONE, read by the time overviews. Kept up to date by the Submission
+    signals and rebuilt from the submissions by the rebuild_monthly_worktime
+    command.
+    """
+
+    employee = models.ForeignKey(Employee)
+    task = models.ForeignKey(Task)
+    year = models.IntegerField()
+    month = models.IntegerField()
+
+    # Summed worktime of the submissions, in hours
+    worktime = models.FloatField(default=0)
+    submissions = models.IntegerField(default=0)
+    # Submissions whose worktime was not extracted automatically. Counted
+    # instead of flagged, so that deleting a submission can clear the flag.
+    untimed_submissions = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('employee', 'task', 'year', 'month'), ]
+        index_together = [('year', 'month'), ]
+
+    @property
+    def incomplete_time(self):
+        return self.untimed_submissions > 0
+
+    def __unicode__(self):
+        return "Monthly worktime: " + " / ".join([
+            self.employee.user.username,
+            self.task.name,
+            '{0}-{1:02d}'.format(self.year, self.month), ])
+
+
+class SubmissionJob(models.Model):
+    """
+    A submission that is waiting for its checks to be run by a submission
+    worker. The upload stays in the spool until then, and the Submission is
+    only created if the checks pass.
+    """
+
+    PENDING = 'pending'
+    PASS = 'pass'
+    FAIL = 'fail'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PASS, 'Pass'),
+        (FAIL, 'Fail'), )
+
+    employee = models.ForeignKey(Employee)
+    work = models.ForeignKey(Work)
+    date = models.DateTimeField('Submission time / date')
+
+    comment = models.TextField(blank=True)
+    is_final = models.BooleanField(default=False)
+    original_filename = models.CharField(max_length=200)
+    spool_path = models.CharField(max_length=400)
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    # Reason for failed checks, reported back to the annotator
+    message = models.TextField(blank=True)
+    finished = models.DateTimeField('Checks finished', blank=True, null=True)
+    submission = models.ForeignKey(Submission, blank=True, null=True,
+                                   default=None, on_delete=models.SET_NULL)
+
+    def __unicode__(self):
+        return "Submission job {0} ({1}): ".format(self.pk, self.status) + \
+               " / ".join([self.work.task.name,
+                           self.employee.user.username,
+                           str(self.date), ])
+
+
+class UploadSession(models.Model):
+    """
+    A submission file that is uploaded in chunks and can be resumed after
+    the connection dropped. The file is submitted once the upload is
+    finalized.
+    """
+
+    employee = models.ForeignKey(Employee)
+    created = models.DateTimeField('Upload started', auto_now_add=True)
+
+    filename = models.CharField(max_length=200)
+    # Announced size in bytes, if known
+    size = models.BigIntegerField(blank=True, null=True)
+    received = models.BigIntegerField(default=0)
+    path = models.CharField(max_length=400)
+
+    comment = models.TextField(blank=True)
+    is_final = models.BooleanField(default=False)
+    is_async = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return "Upload session {0}: {1} / {2} ({3} bytes)".format(
+            self.pk, self.employee.user.username, self.filename,
+            self.received)
+
+
+class OutboxMessage(models.Model):
+    """
+    An e-mail notification waiting to be sent by the run_mail_sender
+    command, see outbox.py.
+    """
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'), )
+
+    created = models.DateTimeField('Queued', auto_now_add=True)
+    # Comma separated addresses
+    recipients = models.TextField()
+    subject = models.CharField(max_length=400)
+    body = models.TextField(blank=True)
+    reply_to = models.CharField(max_length=254, blank=True)
+    # JSON list of [path, filename] of files in NOTIFICATION_OUTBOX_DIR
+    attachments = models.TextField(blank=True, default='[]')
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    sent = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt'), ]
+
+    def __unicode__(self):
+        return "Outbox message {0} ({1}): {2} to {3}".format(
+            self.pk, self.status, self.subject, self.recipients)
+
+
+class TaskImport(models.Model):
+    """
+    Checkpoint of a resumable task import, see
+    knossos_aam_utils.generic_task_importer.resume_import_tasks. Updated in
+    the transaction of every imported batch.
+    """
+
+    # Absolute path of the csv file
+    csv_input = models.CharField(max_length=400, unique=True)
+    started = models.DateTimeField('Import started', auto_now_add=True)
+    updated = models.DateTimeField('Last checkpoint', auto_now=True)
+
+    # Position after the last imported line
+    offset = models.BigIntegerField(default=0)
+    line_number = models.IntegerField(default=0)
+    imported = models.IntegerField(default=0)
+    # Rows of tasks that already existed
+    skipped = models.IntegerField(default=0)
+    finished = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return "Task import {0}: line {1}, {2} imported, {3} skipped".format(
+            self.csv_input, self.line_number, self.imported, self.skipped)
+
+
 pre_save.connect(emc.submission_work_enforce_frozen, sender=Submission)
 pre_save.connect(emc.submission_ensure_valid_path, sender=Submission)
+pre_save.connect(emc.submission_store_monthly_worktime_values, sender=Submission)
 post_save.connect(emc.work_update_post_submission, sender=Submission)
+post_save.connect(emc.submission_update_monthly_worktime, sender=Submission)
+pre_delete.connect(emc.submission_load_delta_dependents, sender=Submission)
+pre_delete.connect(emc.submission_remove_monthly_worktime, sender=Submission)
+post_delete.connect(emc.submission_store_dependents_in_full, sender=Submission)
+post_delete.connect(emc.submission_remove_file, sender=Submission)
 
 post_save.connect(emc.user_username_without_dashes, sender=User)
 post_save.connect(emc.user_create_employee, sender=User)
@@ -222,4 +406,12 @@ post_save.connect(emc.task_category_name_without_dashes, sender=TaskCategory)
 pre_save.connect(emc.task_name_without_dashes, sender=Task)
 pre_save.connect(emc.task_category_name_combination, sender=Task)
 pre_save.connect(emc.task_ensure_valid_path, sender=Task)
+pre_save.connect(emc.task_reset_file_hash, sender=Task)
+post_delete.connect(emc.task_invalidate_cached_file, sender=Task)
 post_save.connect(emc.task_validate_checks, sender=Task)
+
+# After the signals above, which update the coverage of the Task
+post_save.connect(task_dispatcher.task_saved, sender=Task)
+post_delete.connect(task_dispatcher.task_deleted, sender=Task)
+post_save.connect(task_dispatcher.work_saved, sender=Work)
+post_delete.connect(task_dispatcher.work_deleted, sender=Work)
@@ -0,0 +1,253 @@
+"""
+Outbox for e-mail notifications. Notifications are stored as OutboxMessage
+rows by enqueue_mail and sent in the background by the run_mail_sender
+command, so requests never wait for the mail server:
+
+knossos-aam run_mail_sender
+
+The sender keeps one SMTP session open while there is mail to send, sends
+in batches of NOTIFICATION_BATCH_SIZE and retries failed messages with
+exponential backoff. With NOTIFICATION_DIGEST, pending messages to the same
+recipients are combined into one e-mail.
+
+A batch is claimed (status SENDING) in a short transaction and sent outside
+of it, so that no row locks are held while talking to the mail server, and a
+message is never sent twice. Messages that stay SENDING for longer than
+SENDING_TIMEOUT, because their sender died, are marked FAILED, as they may
+or may not have been sent. They can be requeued from the admin.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from general_utilities.mailer import Mailer
+
+import models
+from helpers import ensure_dir
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which a claimed message that was neither sent nor failed is
+# given up on
+SENDING_TIMEOUT = 3600
+
+
+def enqueue_mail(subject, body, recipients=None, attachments=None,
+                 reply_to=None):
+    """
+    Queue an e-mail notification.
+
+    Parameters
+    ----------
+
+    subject : str
+
+    body : str
+
+    recipients : list of str
+        Defaults to NOTIFICATION_RECIPIENTS.
+
+    attachments : list of (str, str)
+        Contents and filename of each attachment. Contents are stored in
+        NOTIFICATION_OUTBOX_DIR until the message is sent.
+
+    reply_to : str or None
+
+    Returns
+    -------
+
+    message : OutboxMessage instance
+    """
+
+    if recipients is None:
+        recipients = settings.NOTIFICATION_RECIPIENTS
+
+    stored_attachments = []
+    if attachments:
+        ensure_dir(settings.NOTIFICATION_OUTBOX_DIR)
+        for data, filename in attachments:
+            fd, path = tempfile.mkstemp(dir=settings.NOTIFICATION_OUTBOX_DIR)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            stored_attachments.append([path, filename])
+
+    return models.OutboxMessage.objects.create(
+        recipients=','.join(recipients),
+        subject=subject[0:400],
+        body=body,
+        reply_to=reply_to or '',
+        attachments=json.dumps(stored_attachments), )
+
+
+def _load_attachments(message):
+    attachments = []
+    for path, filename in json.loads(message.attachments):
+        with open(path, 'rb') as fp:
+            attachments.append((fp.read(), filename))
+
+    return attachments
+
+
+def _remove_attachments(message):
+    for path, _ in json.loads(message.attachments):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _digest(messages):
+    """
+    Combine messages to the same recipients into one subject, body,
+    attachments and reply_to.
+    """
+
+    if len(messages) == 1:
+        m = messages[0]
+        return m.subject, m.body, _load_attachments(m), m.reply_to or None
+
+    subject = 'Digest of {0} notifications'.format(len(messages))
+    body = '\n\n'.join('{0}\n{1}\n\n{2}'.format(
+        m.subject, '-' * len(m.subject), m.body) for m in messages)
+    attachments = []
+    for m in messages:
+        attachments.extend(_load_attachments(m))
+    # Keep reply_to only if all messages agree on it
+    reply_tos = set(m.reply_to for m in messages)
+    reply_to = None
+    if len(reply_tos) == 1:
+        reply_to = reply_tos.pop() or None
+
+    return subject, body, attachments, reply_to
+
+
+class MailSender(object):
+    """
+    Sends the pending OutboxMessages over one SMTP session, which is kept
+    open between batches until close_if_idle.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.last_used = 0.
+
+    def open(self):
+        if self.session is None:
+            self.session = Mailer(settings.NOTIFICATION_SMTP_HOST,
+                                  use_auth=settings.NOTIFICATION_SMTP_AUTH,
+                                  use_smtps=settings.NOTIFICATION_SMTPS,
+                                  smtp_user=settings.NOTIFICATION_SMTP_USER,
+                                  smtp_pass=settings.NOTIFICATION_SMTP_PASSWORD,
+                                  port=settings.NOTIFICATION_SMTP_PORT)
+            self.session.open_session()
+
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.close_session()
+            except Exception:
+                # The server may already have dropped the connection
+                pass
+            self.session = None
+
+    def close_if_idle(self, idle_timeout):
+        if self.session is not None and \
+                time.time() - self.last_used > idle_timeout:
+            self.close()
+
+    def _send(self, recipients, subject, body, attachments, reply_to):
+        try:
+            self.open().send_mail(settings.NOTIFICATION_SENDER,
+                                  recipients,
+                                  subject,
+                                  body,
+                                  attachments=attachments,
+                                  reply_to=reply_to)
+        except Exception:
+            # Start with a new session on the next attempt
+            self.close()
+            raise
+        finally:
+            self.last_used = time.time()
+
+    def send_pending(self):
+        """
+        Send one batch of pending messages that are due.
+
+        Returns
+        -------
+
+        count : int
+            Number of messages that were processed, sent or not.
+        """
+
+        now = timezone.now()
+        models.OutboxMessage.objects.filter(
+            status=models.OutboxMessage.SENDING,
+            next_attempt__lt=now - timedelta(seconds=SENDING_TIMEOUT)).update(
+            status=models.OutboxMessage.FAILED,
+            last_error='Interrupted while sending, the message may have '
+                       'been sent.')
+
+        with transaction.atomic():
+            messages = list(models.OutboxMessage.objects.select_for_update(
+                skip_locked=True).filter(
+                status=models.OutboxMessage.PENDING,
+                next_attempt__lte=now).order_by('pk')[
+                           0:settings.NOTIFICATION_BATCH_SIZE])
+            # next_attempt is the time of the claim while SENDING
+            models.OutboxMessage.objects.filter(
+                pk__in=[m.pk for m in messages]).update(
+                status=models.OutboxMessage.SENDING, next_attempt=now)
+
+        if settings.NOTIFICATION_DIGEST:
+            groups = {}
+            for m in messages:
+                groups.setdefault(m.recipients, []).append(m)
+            groups = groups.values()
+        else:
+            groups = [[m] for m in messages]
+
+        for group in groups:
+            try:
+                subject, body, attachments, reply_to = _digest(group)
+                self._send(group[0].recipients.split(','), subject, body,
+                           attachments, reply_to)
+            except Exception, e:
+                logger.warning('Sending notification failed: %s', e)
+                for m in group:
+                    self._failed(m, e)
+                continue
+
+            for m in group:
+                m.status = models.OutboxMessage.SENT
+                m.sent = timezone.now()
+                m.attempts += 1
+                m.save()
+
+        # Attachments of failed messages are kept, so that they can be
+        # requeued from the admin.
+        for m in messages:
+            if m.status == models.OutboxMessage.SENT:
+                _remove_attachments(m)
+
+        return len(messages)
+
+    def _failed(self, message, error):
+        message.attempts += 1
+        message.last_error = str(error)
+        if message.attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+            message.status = models.OutboxMessage.FAILED
+        else:
+            message.status = models.OutboxMessage.PENDING
+            delay = settings.NOTIFICATION_RETRY_DELAY * \
+                    2 ** (message.attempts - 1)
+            message.next_attempt = timezone.now() + timedelta(seconds=delay)
+        message.save()
@@ -0,0 +1,290 @@
+"""
+Delta storage for submissions. With SUBMISSION_DELTA_STORAGE enabled, only
+the last submission of a Work is stored in full. When a new submission
+arrives, the previous one is replaced by a delta against it, and it is rebuilt
+from the chain of deltas when it is downloaded.
+
+A delta is a zip file with a manifest (delta.json) listing every member of the
+original k.zip as either unchanged in the base, stored in full, or stored as a
+line delta against the same member of the base. Rebuilt k.zips have the same
+members as the original, but are not byte-identical to it.
+
+A datafile is only replaced once the change of delta_base is committed, so
+that a rollback never leaves a delta without its base or the other way round.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import transaction
+
+import models
+from helpers import ensure_dir
+from helpers import hash_file
+from helpers import remove_orphaned_blob
+
+MANIFEST = 'delta.json'
+
+# Members that are diffed line by line, all others are either unchanged or
+# stored in full.
+TEXT_MEMBER_EXTENSIONS = ('.xml', '.nml', '.txt')
+
+
+def _split_lines(data):
+    # Not str.splitlines, which also splits at \r and so would not survive
+    # concatenating and splitting again.
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [x + '\n' for x in lines]
+    if last:
+        lines.append(last)
+
+    return lines
+
+
+def line_delta(lines, base_lines):
+    """
+    Express lines in terms of base_lines.
+
+    Returns
+    -------
+
+    ops : list
+        ['c', start, count] copies count lines of base_lines from start on,
+        ['i', count] inserts the next count lines from literals.
+
+    literals : list of str
+    """
+
+    first_index = {}
+    for j, line in enumerate(base_lines):
+        first_index.setdefault(line, j)
+
+    ops = []
+    literals = []
+    i = 0
+    expected = 0
+    while i < len(lines):
+        # Prefer continuing where the last copy ended, repeated lines would
+        # otherwise always match their first occurrence.
+        if expected < len(base_lines) and lines[i] == base_lines[expected]:
+            j = expected
+        else:
+            j = first_index.get(lines[i])
+
+        if j is None:
+            if ops and ops[-1][0] == 'i':
+                ops[-1][1] += 1
+            else:
+                ops.append(['i', 1])
+            literals.append(lines[i])
+            i += 1
+            continue
+
+        n = 1
+        while i + n < len(lines) and j + n < len(base_lines) \
+                and lines[i + n] == base_lines[j + n]:
+            n += 1
+        ops.append(['c', j, n])
+        i += n
+        expected = j + n
+
+    return ops, literals
+
+
+def apply_line_delta(ops, literals, base_lines):
+    lines = []
+    k = 0
+    for op in ops:
+        if op[0] == 'c':
+            lines.extend(base_lines[op[1]:op[1] + op[2]])
+        else:
+            lines.extend(literals[k:k + op[1]])
+            k += op[1]
+
+    return lines
+
+
+def make_delta(path, base_path, delta_path):
+    """
+    Write a delta of the k.zip at path against the k.zip at base_path to
+    delta_path.
+    """
+
+    with zipfile.ZipFile(path) as zipper, \
+            zipfile.ZipFile(base_path) as base, \
+            zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED) as out:
+        base_infos = dict((x.filename, x) for x in base.infolist())
+        manifest = []
+
+        for info in zipper.infolist():
+            name = info.filename
+            base_info = base_infos.get(name)
+
+            if base_info is not None and \
+                    (base_info.CRC, base_info.file_size) == \
+                    (info.CRC, info.file_size):
+                manifest.append([name, 'same'])
+            elif base_info is not None and \
+                    name.lower().endswith(TEXT_MEMBER_EXTENSIONS):
+                ops, literals = line_delta(_split_lines(zipper.read(name)),
+                                           _split_lines(base.read(name)))
+                out.writestr('literals/' + name, ''.join(literals))
+                manifest.append([name, 'delta', ops])
+            else:
+                out.writestr('full/' + name, zipper.read(name))
+                manifest.append([name, 'full'])
+
+        out.writestr(MANIFEST, json.dumps(manifest))
+
+
+def apply_delta(delta_path, base_path, out_path):
+    """
+    Rebuild the k.zip that the delta at delta_path was made from, using the
+    k.zip at base_path, and write it to out_path.
+    """
+
+    with zipfile.ZipFile(delta_path) as delta, \
+            zipfile.ZipFile(base_path) as base, \
+            zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as out:
+        for entry in json.loads(delta.read(MANIFEST)):
+            name, kind = entry[0], entry[1]
+            if kind == 'same':
+                out.writestr(name, base.read(name))
+            elif kind == 'delta':
+                lines = apply_line_delta(
+                    entry[2],
+                    _split_lines(delta.read('literals/' + name)),
+                    _split_lines(base.read(name)))
+                out.writestr(name, ''.join(lines))
+            else:
+                out.writestr(name, delta.read('full/' + name))
+
+
+def store_as_delta(s, base):
+    """
+    Replace the datafile of Submission s by a delta against the datafile of
+    Submission base, which must be stored in full.
+
+    Returns False, leaving s unchanged, if the files are no k.zips, larger
+    than SUBMISSION_DELTA_MAX_SIZE uncompressed, or the delta would not be
+    smaller than the file.
+    """
+
+    path = s.datafile.path
+    base_path = base.datafile.path
+    if not (zipfile.is_zipfile(path) and zipfile.is_zipfile(base_path)):
+        return False
+
+    for cur_path in (path, base_path):
+        with zipfile.ZipFile(cur_path) as zipper:
+            if sum(x.file_size for x in zipper.infolist()) > \
+                    settings.SUBMISSION_DELTA_MAX_SIZE:
+                return False
+
+    fd, delta_path = tempfile.mkstemp(suffix='.delta',
+                                      dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        make_delta(path, base_path, delta_path)
+    except:
+        os.remove(delta_path)
+        raise
+    if os.path.getsize(delta_path) >= os.path.getsize(path):
+        os.remove(delta_path)
+        return False
+
+    sha256 = s.sha256
+
+    def replace_file():
+        os.rename(delta_path, path)
+        remove_orphaned_blob(sha256)
+
+    # update(), as saving would run the frozen Work constraints, which do not
+    # apply to how the file is stored.
+    with transaction.atomic():
+        models.Submission.objects.filter(pk=s.pk).update(delta_base=base)
+        transaction.on_commit(replace_file)
+
+    s.delta_base = base
+
+    return True
+
+
+@contextmanager
+def full_submission_file(s):
+    """
+    Yield the path of the full k.zip of Submission s, rebuilding it from
+    the chain of deltas into a temporary file if necessary.
+    """
+
+    chain = [s]
+    while chain[-1].delta_base_id is not None:
+        chain.append(chain[-1].delta_base)
+
+    if len(chain) == 1:
+        yield s.datafile.path
+        return
+
+    ensure_dir(settings.SUBMISSION_SPOOL_DIR)
+    path = chain.pop().datafile.path
+    rebuilt_path = None
+    try:
+        for cur_s in reversed(chain):
+            fd, out_path = tempfile.mkstemp(
+                suffix='.k.zip', dir=settings.SUBMISSION_SPOOL_DIR)
+            os.close(fd)
+            apply_delta(cur_s.datafile.path, path, out_path)
+            if rebuilt_path is not None:
+                os.remove(rebuilt_path)
+            path = rebuilt_path = out_path
+
+        yield path
+    finally:
+        if rebuilt_path is not None and os.path.exists(rebuilt_path):
+            os.remove(rebuilt_path)
+
+
+def open_submission_file(s):
+    """
+    Open the full k.zip of Submission s for reading. A rebuilt file is
+    unlinked right away, it disappears once the file object is closed.
+    """
+
+    with full_submission_file(s) as path:
+        return open(path, 'rb')
+
+
+def store_in_full(s):
+    """
+    Replace the delta of Submission s by the full k.zip.
+    """
+
+    if s.delta_base_id is None:
+        return
+
+    path = s.datafile.path
+    fd, tmp_path = tempfile.mkstemp(suffix='.k.zip', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        with full_submission_file(s) as full_path:
+            shutil.copyfile(full_path, tmp_path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+    # The rebuilt file is not byte-identical to the original, and sha256 is
+    # used as its ETag.
+    sha256 = hash_file(tmp_path)
+    with transaction.atomic():
+        models.Submission.objects.filter(pk=s.pk).update(
+            delta_base=None, sha256=sha256)
+        transaction.on_commit(lambda: os.rename(tmp_path, path))
+
+    s.delta_base = None
+    s.sha256 = sha256
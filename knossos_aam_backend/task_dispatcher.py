@@ -0,0 +1,240 @@
+"""
+Optional in-memory dispatcher of available tasks, enabled by the
+TASK_DISPATCHER setting. Each server process keeps, per project and
+category, the claimable tasks sorted by priority, so finding the best task
+for an employee does not rank the tasks in the database on every request.
+
+The queues are kept up to date by the Task and Work signals (connected in
+models.py) of the process itself. Changes that send no signals here, e.g.
+made by other processes or by bulk updates, are picked up when a queue is
+older than TASK_DISPATCHER_MAX_AGE seconds, or when a candidate turns out not
+to be claimable in the database, which every claim confirms (see
+aam_interaction.claim_task).
+"""
+
+import heapq
+import time
+from bisect import bisect_left, insort
+from itertools import islice
+from threading import RLock
+
+from django.conf import settings
+
+import models
+
+
+def _is_claimable(task):
+    return task.is_active and task.priority > -1 and \
+           task.current_coverage < task.target_coverage
+
+
+def _available(keys, worked):
+    return (x for x in keys if x[1] not in worked)
+
+
+def _key(task):
+    # Sorts by descending priority, then by primary key
+    return -task.priority, task.pk
+
+
+class TaskDispatcher(object):
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = RLock()
+        # project pk -> category pk -> sorted list of task keys
+        self.queues = {}
+        # project pk -> time the queue was built
+        self.built = {}
+        # category pk -> project pk, for the categories of built projects
+        self.projects = {}
+        # task pk -> (category pk, key), for the tasks in the queues
+        self.entries = {}
+        # employee pk -> (load time, set of task pks the employee worked on)
+        self.worked = {}
+
+    def _queue(self, project_pk):
+        if time.time() - self.built.get(project_pk, 0.) > self.max_age:
+            self.rebuild(project_pk)
+
+        return self.queues[project_pk]
+
+    def rebuild(self, project_pk):
+        with self.lock:
+            for category_pk in self.queues.get(project_pk, {}):
+                del self.projects[category_pk]
+            for task_pk in [k for k, v in self.entries.iteritems()
+                            if v[0] not in self.projects]:
+                del self.entries[task_pk]
+
+            queue = {}
+            for category_pk in models.TaskCategory.objects.filter(
+                    project_id=project_pk).values_list('pk', flat=True):
+                queue[category_pk] = []
+                self.projects[category_pk] = project_pk
+
+            for task in models.Task.objects.filter(
+                    category__project_id=project_pk).only(
+                    'pk', 'category', 'priority', 'is_active',
+                    'current_coverage', 'target_coverage').iterator():
+                if _is_claimable(task):
+                    key = _key(task)
+                    queue[task.category_id].append(key)
+                    self.entries[task.pk] = (task.category_id, key)
+            for keys in queue.itervalues():
+                keys.sort()
+
+            self.queues[project_pk] = queue
+            self.built[project_pk] = time.time()
+
+    def _worked(self, employee_pk):
+        loaded, task_pks = self.worked.get(employee_pk, (0., None))
+        if time.time() - loaded > self.max_age:
+            task_pks = set(models.Work.objects.filter(
+                employee_id=employee_pk).values_list('task_id', flat=True))
+            self.worked[employee_pk] = (time.time(), task_pks)
+
+        return task_pks
+
+    def available_by_category(self, employee, count):
+        """
+        Returns
+        -------
+
+        task_pks_by_cat : dict of int -> list of int
+            Maps category pk to the pks of the count tasks with the highest
+            priority available to employee.
+        """
+
+        with self.lock:
+            worked = self._worked(employee.pk)
+            return dict(
+                (category_pk,
+                 [x[1] for x in islice(_available(keys, worked), count)])
+                for category_pk, keys in
+                self._queue(employee.project_id).iteritems())
+
+    def candidates(self, employee, count):
+        """
+        Returns
+        -------
+
+        task_pks : list of int
+            The count tasks with the highest priority available to employee,
+            in the order they should be claimed.
+        """
+
+        with self.lock:
+            worked = self._worked(employee.pk)
+            merged = heapq.merge(*[
+                _available(keys, worked)
+                for keys in self._queue(employee.project_id).itervalues()])
+            return [x[1] for x in islice(merged, count)]
+
+    def invalidate(self):
+        """
+        Rebuild all queues on their next use, e.g. after bulk changes that
+        sent no signals.
+        """
+
+        with self.lock:
+            self.built.clear()
+            self.worked.clear()
+
+    def drifted(self, employee):
+        """
+        A candidate task turned out not to be claimable by employee, i.e.
+        the queue missed a change made by another process.
+        """
+
+        with self.lock:
+            self.built.pop(employee.project_id, None)
+            self.worked.pop(employee.pk, None)
+
+    def update_task(self, task):
+        with self.lock:
+            self.remove_task(task.pk)
+            project_pk = self.projects.get(task.category_id)
+            if project_pk is None:
+                # New category, or not a built project
+                project_pk = task.category.project_id
+                if project_pk not in self.queues:
+                    return
+                self.projects[task.category_id] = project_pk
+                self.queues[project_pk][task.category_id] = []
+
+            if _is_claimable(task):
+                key = _key(task)
+                insort(self.queues[project_pk][task.category_id], key)
+                self.entries[task.pk] = (task.category_id, key)
+
+    def remove_task(self, task_pk):
+        with self.lock:
+            entry = self.entries.pop(task_pk, None)
+            if entry is None:
+                return
+            category_pk, key = entry
+            keys = self.queues[self.projects[category_pk]][category_pk]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def update_work(self, work, deleted=False):
+        with self.lock:
+            if work.employee_id in self.worked:
+                task_pks = self.worked[work.employee_id][1]
+                if deleted:
+                    task_pks.discard(work.task_id)
+                else:
+                    task_pks.add(work.task_id)
+            self.update_task(work.task)
+
+
+_dispatcher = None
+_dispatcher_lock = RLock()
+
+
+def get_dispatcher():
+    """
+    Returns
+    -------
+
+    dispatcher : TaskDispatcher or None
+        The dispatcher of this process, None if TASK_DISPATCHER is disabled.
+    """
+
+    global _dispatcher
+
+    if not settings.TASK_DISPATCHER:
+        return None
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = TaskDispatcher(settings.TASK_DISPATCHER_MAX_AGE)
+
+    return _dispatcher
+
+
+#
+# Signal handlers. They do nothing until the dispatcher is first used.
+#
+
+
+def task_saved(sender, instance, **kwargs):
+    if _dispatcher is not None:
+        _dispatcher.update_task(instance)
+
+
+def task_deleted(sender, instance, **kwargs):
+    if _dispatcher is not None:
+        _dispatcher.remove_task(instance.pk)
+
+
+def work_saved(sender, instance, created, **kwargs):
+    # Only new Works change the coverage
+    if _dispatcher is not None and created:
+        _dispatcher.update_work(instance)
+
+
+def work_deleted(sender, instance, **kwargs):
+    if _dispatcher is not None:
+        _dispatcher.update_work(instance, deleted=True)
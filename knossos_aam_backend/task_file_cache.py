@@ -0,0 +1,125 @@
+"""
+In-memory LRU cache of task files, shared by the threads of a server
+process. A task with target coverage N is downloaded by N annotators, so the
+files of tasks that are currently handed out are served from memory instead
+of being read from disk on every request.
+
+Entries are keyed by task and validated against the task file name and its
+hash, and dropped when the task file changes (see
+enforce_model_constraints.task_reset_file_hash). TASK_FILE_CACHE_SIZE bounds
+the total size in bytes, 0 disables the cache.
+"""
+
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from django.conf import settings
+
+
+class CachedTaskFile(object):
+    def __init__(self, name, sha256, data):
+        self.name = name
+        self.sha256 = sha256
+        self.data = data
+        # Headers that only depend on the file
+        self.headers = {
+            'Content-Length': str(len(data)),
+            'Accept-Ranges': 'bytes', }
+
+
+class TaskFileCache(object):
+    def __init__(self, max_size, max_file_size):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.lock = Lock()
+        # task pk -> CachedTaskFile, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, task, sha256):
+        """
+        Return the CachedTaskFile of task, reading the file if it is not
+        cached, or None if the file is too large to be cached.
+        """
+
+        name = task.task_file.name
+        with self.lock:
+            entry = self.entries.pop(task.pk, None)
+            if entry is not None and (entry.name, entry.sha256) == (name, sha256):
+                self.entries[task.pk] = entry
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.size -= len(entry.data)
+            self.misses += 1
+
+        # Read outside of the lock, hits on other files need not wait
+        path = task.task_file.path
+        if os.path.getsize(path) > self.max_file_size:
+            return None
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        entry = CachedTaskFile(name, sha256, data)
+
+        with self.lock:
+            old_entry = self.entries.pop(task.pk, None)
+            if old_entry is not None:
+                self.size -= len(old_entry.data)
+            self.entries[task.pk] = entry
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.data)
+
+        return entry
+
+    def invalidate(self, task_pk):
+        with self.lock:
+            entry = self.entries.pop(task_pk, None)
+            if entry is not None:
+                self.size -= len(entry.data)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'files': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size, }
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def get_cache():
+    """
+    Returns
+    -------
+
+    cache : TaskFileCache or None
+        The cache of this process, None if TASK_FILE_CACHE_SIZE is 0.
+    """
+
+    global _cache
+
+    if not settings.TASK_FILE_CACHE_SIZE:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = TaskFileCache(
+                settings.TASK_FILE_CACHE_SIZE,
+                min(settings.TASK_FILE_CACHE_MAX_FILE_SIZE,
+                    settings.TASK_FILE_CACHE_SIZE))
+
+    return _cache
+
+
+def invalidate(task_pk):
+    if _cache is not None:
+        _cache.invalidate(task_pk)
@@ -47,11 +47,23 @@ urlpatterns = [
     url(r'^task-files/(.*)$',
         views.download_task_file_view,
         name='download_task_file'),
+    url(r'^submission-files/(?P<submission_id>\d+)/?$',
+        views.download_submission_view,
+        name='download_submission'),
     url(r'^logout/?$',
         views.logout_view,
         name='logout'),
     url(r"^employee_work_overview/?$", views.employee_work_overview, name="employee_work_overview"),
     url(r"^employee_project_overview/?$", views.employee_project_overview, name="employee_project_overview"),
+    url(r'^assign_tasks/?$',
+        views.assign_tasks_view,
+        name='assign_tasks'),
+    url(r'^task_file_cache_stats/?$',
+        views.task_file_cache_stats_view,
+        name='task_file_cache_stats'),
+    url(r'^export_worktime\.(?P<fmt>csv|ndjson)$',
+        views.export_worktime_view,
+        name='export_worktime'),
 
     # for KNOSSOS
     url(r'api/2/session/?$', views_api.session_api_view),
@@ -59,6 +71,10 @@ urlpatterns = [
     url(r'api/2/logout/?$', views_api.logout_api_view),
     url(r'api/2/submit/?$', views_api.submit_api_view),
     url(r'api/2/submit_test/?$', views_api.submit_test_api_view),
+    url(r'api/2/submission_status/(?P<job_id>\d+)/?$', views_api.submission_status_api_view),
+    url(r'api/2/upload_session/?$', views_api.upload_session_create_api_view),
+    url(r'api/2/upload_session/(?P<session_id>\d+)/?$', views_api.upload_session_api_view),
+    url(r'api/2/upload_session/(?P<session_id>\d+)/finalize/?$', views_api.upload_session_finalize_api_view),
     url(r'api/2/new_task/?$', views_api.new_task_api_view),
     url(r'api/2/current_file/?$', views_api.current_file_api_view),
     url(r'knossos/.*$', views_api.obsolete_api_view),  # appears to not work the way it was intended, not sure why
@@ -1,7 +1,19 @@
-from django.http import HttpResponse
-from general_utilities.mailer import Mailer
+import os
+import re
 
+from django.conf import settings
+from django.http import FileResponse
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.http import StreamingHttpResponse
+from django.utils import encoding
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+
+import task_file_cache
+from helpers import CHUNK_SIZE
 from models import Employee
+from outbox import enqueue_mail
 
 __author__ = 'Fabian Svara'
 
@@ -27,22 +39,188 @@ class KnossosIntegrationError(Exception):
 
 
 def mail_notify(to, subject, body, attachments=None, reply_to=None):
-    ma = Mailer('mail',
-                use_auth=True,
-                use_smtps=True,
-                smtp_user='username',
-                smtp_pass='password',
-                port=465)
-    ma.open_session()
-
-    ma.send_mail('sender@example.com',
-                 ['recipient@example.com'],
-                 subject,
-                 body,
-                 attachments=attachments,
+    """
+    Queue an e-mail notification, which is sent by run_mail_sender, see
+    outbox.py.
+    """
+
+    enqueue_mail(subject, body, recipients=[to], attachments=attachments,
                  reply_to=reply_to)
 
-    ma.close_session()
+
+def _requested_range(request, size, etag):
+    """
+    Parse the Range header of request for a file of size bytes.
+
+    Returns
+    -------
+
+    byte_range : (int, int) or None
+        First and last byte requested, None for the whole file. Multiple
+        ranges are not supported and also answered with the whole file.
+
+    Raises
+    ------
+
+    ValueError:
+
+    if the range cannot be satisfied.
+    """
+
+    m = re.match(r'^bytes=(\d*)-(\d*)$',
+                 request.META.get('HTTP_RANGE', '').strip())
+    if m is None or m.groups() == ('', ''):
+        return None
+
+    # A changed file is sent as a whole
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and (etag is None or if_range.strip() != etag):
+        return None
+
+    first, last = m.groups()
+    if first == '':
+        # Suffix range: the last bytes of the file
+        first = max(0, size - int(last))
+        last = size - 1
+    else:
+        first = int(first)
+        last = size - 1 if last == '' else min(int(last), size - 1)
+
+    if first > last or first >= size:
+        raise ValueError('Unsatisfiable range.')
+
+    return first, last
+
+
+def _iter_range(fp, first, last):
+    try:
+        fp.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        fp.close()
+
+
+def file_response(request, path, content_disposition, fp=None, etag=None,
+                  content_type='application/nml'):
+    """
+    Response delivering the file at path, as configured by
+    FILE_DELIVERY_BACKEND: streamed by Django, or sent by the web server
+    through X-Sendfile (Apache mod_xsendfile) or X-Accel-Redirect (nginx).
+
+    With an etag, If-None-Match is answered with 304 Not Modified. Range
+    requests are answered by Django when it streams the file, and by the web
+    server otherwise.
+
+    Parameters
+    ----------
+
+    request : HttpRequest
+
+    path : str
+        Absolute path of the file, below MEDIA_ROOT for X-Accel-Redirect
+
+    content_disposition : str
+
+    fp : file object or None
+        Already opened file to stream instead, e.g. a temporary file that the
+        web server cannot access. path is ignored then.
+
+    etag : str or None
+        Strong validator of the file contents, e.g. its hash
+
+    content_type : str
+    """
+
+    if etag is not None:
+        etag = quote_etag(etag)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if if_none_match.strip() == '*' or etag in parse_etags(if_none_match):
+            if fp is not None:
+                fp.close()
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+    backend = settings.FILE_DELIVERY_BACKEND
+    if fp is not None or backend == 'django':
+        if fp is None:
+            fp = open(path, 'rb')
+        size = os.fstat(fp.fileno()).st_size
+
+        try:
+            byte_range = _requested_range(request, size, etag)
+        except ValueError:
+            fp.close()
+            response = HttpResponse('Requested range not satisfiable.',
+                                    status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+
+        if byte_range is None:
+            response = FileResponse(fp, content_type=content_type)
+            response['Content-Length'] = size
+        else:
+            first, last = byte_range
+            response = StreamingHttpResponse(
+                _iter_range(fp, first, last), content_type=content_type,
+                status=206)
+            response['Content-Length'] = last - first + 1
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                first, last, size)
+        response['Accept-Ranges'] = 'bytes'
+    elif backend == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = encoding.smart_str(path)
+    elif backend == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = encoding.smart_str(
+            settings.FILE_DELIVERY_ACCEL_PREFIX +
+            os.path.relpath(path, settings.MEDIA_ROOT))
+    else:
+        raise ValueError(
+            'Unknown FILE_DELIVERY_BACKEND {0}'.format(backend))
+
+    response['Content-Disposition'] = content_disposition
+    if etag is not None:
+        response['ETag'] = etag
+
+    return response
+
+
+def task_file_response(request, task, content_disposition, etag):
+    """
+    Like file_response for the task file of task, with etag from
+    aam_interaction.task_file_etag. Whole-file downloads are served from
+    the task file cache if it is enabled.
+    """
+
+    cache = task_file_cache.get_cache()
+    if cache is None or settings.FILE_DELIVERY_BACKEND != 'django' or \
+            etag is None or 'HTTP_RANGE' in request.META or \
+            'HTTP_IF_NONE_MATCH' in request.META:
+        return file_response(request, task.task_file.path,
+                             content_disposition, etag=etag)
+
+    entry = cache.get(task, etag)
+    if entry is None:
+        # Too large to be cached
+        return file_response(request, task.task_file.path,
+                             content_disposition, etag=etag)
+
+    response = HttpResponse(entry.data, content_type='application/nml')
+    for header, value in entry.headers.iteritems():
+        response[header] = value
+    response['ETag'] = quote_etag(etag)
+    # Not cached, as it depends on other fields of the task and category
+    response['Content-Disposition'] = content_disposition
+
+    return response
 
 
 def login_required_403(fn):
@@ -10,13 +10,19 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.utils import encoding
 from django.utils import timezone
 
 import aam_interaction as aami
 import models
+import submission_deltas
+import task_file_cache
+import worktime_export
 from view_helpers import admin_check
+from view_helpers import file_response
+from view_helpers import task_file_response
 
 __author__ = 'Fabian Svara'
 
@@ -119,8 +125,8 @@ def changetask_view(request):
 @login_required
 def usertime_view(request):
     e = get_object_or_404(models.Employee, user=request.user)
-    s = models.Submission.objects.filter(employee=e)
-    worktime_overview = aami.get_monthly_worktime_for_submissions(s)
+    worktime_overview = aami.get_monthly_worktime(
+        models.MonthlyWorktime.objects.filter(employee=e))
 
     context = {'employee': e,
                'totals': worktime_overview['by_month_totals'],
@@ -132,27 +138,13 @@ def usertime_view(request):
 @login_required
 @user_passes_test(admin_check)
 def monthoverview_view(request, year, month):
-    timeoverview_totals = {}
-    timeoverview_details = {}
-
-    for e in models.Employee.objects.all():
-        timeoverview_totals[e] = {}
-        timeoverview_details[e] = {}
-
-        subs = models.Submission.objects.filter(
-            employee=e,
-            date__year=year,
-            date__month=month, )
-
-        worktime_overview = aami.get_monthly_worktime_for_submissions(subs)
-
-        timeoverview_totals[e] = worktime_overview['by_month_totals']
-        timeoverview_details[e] = worktime_overview['by_month_per_task']
+    worktime_overview = aami.get_monthly_worktime_by_employee(
+        models.MonthlyWorktime.objects.filter(year=year, month=month))
 
     context = {'year': year,
                'month': month,
-               'totals': timeoverview_totals,
-               'per_task': timeoverview_details, }
+               'totals': worktime_overview['by_month_totals'],
+               'per_task': worktime_overview['by_month_per_task'], }
 
     return render(request, 'knossos_aam_backend/monthoverview.html', context)
 
@@ -160,36 +152,13 @@ def monthoverview_view(request, year, month):
 @login_required
 @user_passes_test(admin_check)
 def monthoverview_sort_by_project_view(request, year, month):
-    timeoverview_project_totals = {}
-    timeoverview_project_details = {}
-
-    for p in models.Project.objects.all():
-        timeoverview_employee_totals = {}
-        timeoverview_employee_details = {}
-
-        for e in p.employee_set.all():
-            timeoverview_employee_totals[e] = {}
-            timeoverview_employee_details[e] = {}
-
-            subs = models.Submission.objects.filter(
-                employee=e,
-                date__year=year,
-                date__month=month, )
-
-            worktime_overview = aami.get_monthly_worktime_for_submissions(subs)
-
-            timeoverview_employee_totals[e] = \
-                worktime_overview['by_month_totals']
-            timeoverview_employee_details[e] = \
-                worktime_overview['by_month_per_task']
-
-        timeoverview_project_totals[p] = timeoverview_employee_totals
-        timeoverview_project_details[p] = timeoverview_employee_details
+    worktime_overview = aami.get_monthly_worktime_by_project(
+        models.MonthlyWorktime.objects.filter(year=year, month=month))
 
     context = {'year': year,
                'month': month,
-               'totals': timeoverview_project_totals,
-               'per_task': timeoverview_project_details, }
+               'totals': worktime_overview['by_month_totals'],
+               'per_task': worktime_overview['by_month_per_task'], }
 
     return render(request, 'knossos_aam_backend/monthoverview_projects.html', context)
 
@@ -238,54 +207,71 @@ def sort_by_project_view(request):
                           request.POST['sort_by_name_stats_month'],)))
 
 
-@login_required
-@user_passes_test(admin_check)
-def timeoverview_view(request):
-    timeoverview_totals = {}
-    timeoverview_details = {}
+def _timeoverview_page(request):
+    """
+    The monthly worktimes of a time overview page. The optional GET
+    parameters start and end (YYYY-MM) give the first and last month,
+    by default the last TIMEOVERVIEW_DEFAULT_MONTHS months are shown. The
+    page continues after the employee with pk after.
 
-    for e in models.Employee.objects.all():
-        timeoverview_totals[e] = {}
-        timeoverview_details[e] = {}
+    Returns
+    -------
 
-        worktime_overview = aami.get_monthly_worktime_for_submissions(e.submission_set)
+    worktimes : QuerySet(MonthlyWorktime)
 
-        timeoverview_totals[e] = worktime_overview['by_month_totals']
-        timeoverview_details[e] = worktime_overview['by_month_per_task']
+    context : dict
+        Range and paging for the template.
+    """
 
-    context = {'totals': timeoverview_totals,
-               'per_task': timeoverview_details, }
+    start = request.GET.get('start') or '{0}-{1:02d}'.format(
+        *aami.last_months(settings.TIMEOVERVIEW_DEFAULT_MONTHS))
+    end = request.GET.get('end') or ''
+    after = request.GET.get('after') or None
 
-    return render(request, 'knossos_aam_backend/timeoverview.html', context)
+    worktimes = aami.monthly_worktime_in_range(
+        models.MonthlyWorktime.objects.all(),
+        aami.parse_month(start),
+        aami.parse_month(end) if end else None)
+    worktimes, next_after = aami.monthly_worktime_page(
+        worktimes,
+        int(after) if after is not None else None,
+        settings.TIMEOVERVIEW_PAGE_SIZE)
+
+    return worktimes, {'start': start,
+                       'end': end,
+                       'next_after': next_after, }
 
 
 @login_required
 @user_passes_test(admin_check)
-def timeoverview_sort_by_project_view(request):
-    timeoverview_project_totals = {}
-    timeoverview_project_details = {}
+def timeoverview_view(request):
+    try:
+        worktimes, context = _timeoverview_page(request)
+    except ValueError:
+        return HttpResponse('start and end must be given as YYYY-MM, after '
+                            'as employee id.', status=400)
+
+    worktime_overview = aami.get_monthly_worktime_by_employee(worktimes)
 
-    for p in models.Project.objects.all():
-        timeoverview_employee_totals = {}
-        timeoverview_employee_details = {}
+    context.update({'totals': worktime_overview['by_month_totals'],
+                    'per_task': worktime_overview['by_month_per_task'], })
 
-        for e in p.employee_set.all():
-            timeoverview_employee_totals[e] = {}
-            timeoverview_employee_details[e] = {}
+    return render(request, 'knossos_aam_backend/timeoverview.html', context)
 
-            worktime_overview = aami.get_monthly_worktime_for_submissions(
-                e.submission_set)
 
-            timeoverview_employee_totals[e] = \
-                worktime_overview['by_month_totals']
-            timeoverview_employee_details[e] = \
-                worktime_overview['by_month_per_task']
+@login_required
+@user_passes_test(admin_check)
+def timeoverview_sort_by_project_view(request):
+    try:
+        worktimes, context = _timeoverview_page(request)
+    except ValueError:
+        return HttpResponse('start and end must be given as YYYY-MM, after '
+                            'as employee id.', status=400)
 
-        timeoverview_project_totals[p] = timeoverview_employee_totals
-        timeoverview_project_details[p] = timeoverview_employee_details
+    worktime_overview = aami.get_monthly_worktime_by_project(worktimes)
 
-    context = {'totals': timeoverview_project_totals,
-               'per_task': timeoverview_project_details}
+    context.update({'totals': worktime_overview['by_month_totals'],
+                    'per_task': worktime_overview['by_month_per_task']})
 
     return render(request, 'knossos_aam_backend/timeoverview_projects.html', context)
 
@@ -322,6 +308,102 @@ def employee_project_overview(request):
     return render(request, "knossos_aam_backend/employee_project_overview.html", context)
 
 
+@login_required
+@user_passes_test(admin_check)
+def assign_tasks_view(request):
+    """
+    POST: Assign many tasks at once, see aam_interaction.bulk_assign_tasks.
+    The JSON body either lists pairs,
+
+    {"pairs": [["username", task id], ...]}
+
+    or employees and tasks to distribute over them in turn,
+
+    {"employees": ["username", ...], "tasks": [task id, ...]}
+
+    Replies with the number of created works and the skipped pairs, with
+    the reason they were skipped.
+    """
+
+    if request.method != 'POST':
+        return HttpResponse('POST required.', status=405)
+
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+        if 'pairs' in data:
+            usernames = set(x[0] for x in data['pairs'])
+        else:
+            usernames = set(data['employees'])
+        employee_pks = dict(models.Employee.objects.filter(
+            user__username__in=usernames).values_list('user__username', 'pk'))
+        if len(employee_pks) != len(usernames):
+            raise aami.InvalidAssignment('Unknown users: {0}'.format(
+                ', '.join(sorted(usernames - set(employee_pks.keys())))))
+
+        if 'pairs' in data:
+            assignments = [(employee_pks[x[0]], int(x[1])) for x in data['pairs']]
+        else:
+            assignments = aami.round_robin_assignment(
+                [employee_pks[x] for x in data['employees']],
+                [int(x) for x in data['tasks']])
+
+        count, skipped = aami.bulk_assign_tasks(assignments)
+    except (ValueError, KeyError, TypeError, IndexError):
+        return HttpResponse(json.dumps({'error': 'Malformed request.'}, indent=4),
+                            content_type='application/json', status=400)
+    except aami.InvalidAssignment, e:
+        return HttpResponse(json.dumps({'error': str(e)}, indent=4),
+                            content_type='application/json', status=400)
+
+    usernames = dict((v, k) for k, v in employee_pks.iteritems())
+    skipped = [[usernames[x[0]], x[1], x[2]] for x in skipped]
+
+    return HttpResponse(json.dumps({'created': count, 'skipped': skipped},
+                                   indent=4),
+                        content_type='application/json')
+
+
+@login_required
+@user_passes_test(admin_check)
+def task_file_cache_stats_view(request):
+    """
+    Hit and miss counters of the task file cache of the server process that
+    answers the request.
+    """
+
+    cache = task_file_cache.get_cache()
+    stats = {'enabled': False} if cache is None else dict(
+        cache.stats(), enabled=True)
+
+    return HttpResponse(json.dumps(stats, indent=4),
+                        content_type='application/json')
+
+
+@login_required
+@user_passes_test(admin_check)
+def export_worktime_view(request, fmt):
+    """
+    Stream the monthly worktime per employee and task as csv or ndjson, see
+    worktime_export.py. The optional GET parameters start and end (YYYY-MM)
+    give the first and last month.
+    """
+
+    try:
+        start, end = [aami.parse_month(request.GET[x]) if request.GET.get(x)
+                      else None for x in ('start', 'end')]
+    except ValueError:
+        return HttpResponse('start and end must be given as YYYY-MM.',
+                            status=400)
+
+    response = StreamingHttpResponse(
+        worktime_export.export(fmt, start, end),
+        content_type=worktime_export.CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = \
+        'attachment; filename="worktime.{0}"'.format(fmt)
+
+    return response
+
+
 @login_required
 def error_view(request, error_string):
     return render(request, 'knossos_aam_backend/error.html', {'error_string': error_string})
@@ -333,21 +415,34 @@ def download_task_file_view(request, filename):
     # download arbitrary files..
     path_to_file = settings.MEDIA_ROOT + '/task-files/{0}'.format(filename).rstrip('\n')
 
-    with open(path_to_file, 'r') as f:
-        task_file = f.read()
+    content_disposition = 'attachment; filename={0}'.format(
+        encoding.smart_str(filename))
 
-    response = HttpResponse(task_file, content_type='application/nml')
-    response['Content-Length'] = os.path.getsize(path_to_file)
-    response['Content-Disposition'] = 'attachment; filename={0}'.format(encoding.smart_str(filename))
+    task = models.Task.objects.filter(
+        task_file='task-files/{0}'.format(filename)).first()
+    if task is None:
+        return file_response(request, path_to_file, content_disposition)
 
-    return response
+    return task_file_response(request, task, content_disposition,
+                              aami.task_file_etag(task))
+
+
+@login_required
+def download_submission_view(request, submission_id):
+    s = get_object_or_404(models.Submission, pk=submission_id)
+    if s.employee.user != request.user and not admin_check(request.user):
+        return HttpResponse("Permission denied.", status=403)
+
+    content_disposition = 'attachment; filename={0}'.format(
+        encoding.smart_str(os.path.basename(s.datafile.name)))
+
+    if s.delta_base_id is None:
+        return file_response(request, s.datafile.path, content_disposition,
+                             etag=aami.submission_file_etag(s))
 
-    # using apache modxsendfile seems to be the "better way" because the file doesn't need
-    # to be read by django into memory first. But this requires apache setup
-    # response = HttpResponse(mimetype='application/force-download')
-    # response['Content-Disposition'] = 'attachment; filename={0}'.format(encoding.smart_str(filename))
-    # response['X-Sendfile'] = encoding.smart_str(path_to_file)
-    # return response
+    # Rebuilt from deltas into a temporary file
+    return file_response(request, None, content_disposition,
+                         fp=submission_deltas.open_submission_file(s))
 
 
 def logout_view(request):
@@ -15,15 +15,28 @@ from django.utils import encoding
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.csrf import ensure_csrf_cookie
 
-from aam_interaction import choose_task
+from aam_interaction import InvalidUploadChunk
+from aam_interaction import claim_task
+from aam_interaction import create_upload_session
+from aam_interaction import delete_upload_session
 from aam_interaction import get_active_work
-from aam_interaction import get_available_tasks
+from aam_interaction import submission_file_etag
 from aam_interaction import submit
+from aam_interaction import submit_async
+from aam_interaction import task_file_etag
+from aam_interaction import write_upload_chunk
+from helpers import SpooledFile
+from helpers import link_spooled_file
 from models import Employee
+from models import SubmissionJob
+from models import UploadSession
 from models import Work
 from view_helpers import InvalidSubmission
 from view_helpers import ParseError
+from view_helpers import TooManyActiveTasks
+from view_helpers import file_response
 from view_helpers import login_required_403
+from view_helpers import task_file_response
 
 __author__ = 'Fabian Svara'
 
@@ -120,29 +133,27 @@ def current_file_api_view(request):
     if work.last_submission is None:
         # no submit yet. send the task file instead.
         filename = work.task.task_file.name
-        path_to_file = work.task.task_file.path
 
-        with open(path_to_file, 'r') as f:
-            task_file = f.read()
-
-        response = HttpResponse(task_file, content_type='application/nml')
-        response['Content-Length'] = os.path.getsize(path_to_file)
-        response['Content-Disposition'] = \
+        response = task_file_response(
+            request,
+            work.task,
             'attachment; filename={0}; taskname={1} / {2};'.format(
                 encoding.smart_str(os.path.basename(filename)),
                 work.task.category.name,
-                work.task.name)
+                work.task.name),
+            task_file_etag(work.task))
     else:
+        # The last submission of a work is always stored in full, see
+        # submission_deltas.py
         latest_submission = work.last_submission
         filename = latest_submission.datafile.name
         path_to_file = latest_submission.datafile.path
-        with open(path_to_file, 'r') as f:
-            task_file = f.read()
 
-        response = HttpResponse(task_file, content_type='application/nml')
-        response['Content-Length'] = os.path.getsize(path_to_file)
-        response['Content-Disposition'] = \
-            'attachment; filename={0};'.format(encoding.smart_str(os.path.basename(filename)))
+        response = file_response(
+            request,
+            path_to_file,
+            'attachment; filename={0};'.format(encoding.smart_str(os.path.basename(filename))),
+            etag=submission_file_etag(latest_submission))
 
     return response
 
@@ -158,29 +169,26 @@ def new_task_api_view(request):
             "Please finish your current task first.",
             status=400)
 
-    available_tasks_by_cat, available_tasks = get_available_tasks(emp)
+    try:
+        task = claim_task(emp)
+    except TooManyActiveTasks:
+        return HttpResponse(
+            "Please finish your current task first.",
+            status=400)
 
-    if not available_tasks:
+    if task is None:
         return HttpResponse("No new tasks available at the moment.", status=400)
 
-    task = available_tasks[0]
-    choose_task(emp, task.pk)
-
     filename = task.task_file.name
-    path_to_file = task.task_file.path
-
-    with open(path_to_file, 'r') as f:
-        task_file = f.read()
 
-    response = HttpResponse(task_file, content_type='application/nml')
-    response['Content-Length'] = os.path.getsize(path_to_file)
-    response['Content-Disposition'] = (
+    response = task_file_response(request, task, (
         'attachment; filename={0}; taskname={1} / {2}; description={3}; '
         'comment={4};'.format(encoding.smart_str(os.path.basename(filename)),
                          task.category.name,
                          task.name,
                          b64encode(task.category.description.encode('utf-8')),
-                         b64encode(task.comment.encode('utf-8'))))
+                         b64encode(task.comment.encode('utf-8')))),
+        task_file_etag(task))
 
     return response
 
@@ -207,6 +215,12 @@ def submit_api_view(request):
     else:
         final = False
 
+    return _submit_to_active_work(
+        emp, submit_file, comment, final,
+        request.POST.get('submit_async', "False") == "True")
+
+
+def _submit_to_active_work(emp, submit_file, comment, final, is_async):
     active_work = get_active_work(emp)
     if not active_work:
         return HttpResponse(
@@ -214,6 +228,19 @@ def submit_api_view(request):
             'new task first.', status=400)
     task = active_work[0]
 
+    if is_async:
+        try:
+            job = submit_async(emp, submit_file, comment, final, task.pk)
+        except InvalidSubmission, e:
+            return HttpResponse("Invalid submission: " + str(e), status=400)
+        except Work.DoesNotExist:
+            return HttpResponse("Could not find corresponding Work item.", status=400)
+
+        response_str = json.dumps({'job_id': job.pk, 'status': job.status}, indent=4)
+
+        return HttpResponse(
+            response_str, content_type='application/json', status=202)
+
     try:
         submit(emp, submit_file, comment, final, task.pk)
     except ParseError:
@@ -229,6 +256,168 @@ def submit_api_view(request):
     return HttpResponse("Submitted task successfully.", status=201)
 
 
+def _upload_file_missing(upload_session):
+    # E.g. removed from the spool by hand
+    delete_upload_session(upload_session)
+    return HttpResponse(
+        "The uploaded file is missing, please upload it again.", status=410)
+
+
+@login_required_403
+def upload_session_create_api_view(request):
+    """
+    POST: Start a resumable upload of a submission to the currently active
+    task. The file is then sent in chunks with PUT to
+    upload_session/<session_id> and submitted with a POST to
+    upload_session/<session_id>/finalize. Takes the same fields as submit,
+    plus filename and size. Return json formatted reply.
+    """
+
+    if request.method != 'POST':
+        return HttpResponse("Please use POST.", status=405)
+
+    emp = Employee.objects.get(user=request.user)
+
+    filename = request.POST.get('filename', '')
+    if not filename:
+        return HttpResponse("No filename given.", status=400)
+
+    try:
+        size = int(request.POST['size']) if 'size' in request.POST else None
+    except ValueError:
+        return HttpResponse("Invalid size.", status=400)
+
+    try:
+        upload_session = create_upload_session(
+            emp, filename, size,
+            request.POST.get('submit_comment', ''),
+            request.POST.get('submit_work_is_final', "False") == "True",
+            request.POST.get('submit_async', "False") == "True")
+    except InvalidSubmission, e:
+        return HttpResponse("Invalid submission: " + str(e), status=400)
+
+    response_str = json.dumps({'session_id': upload_session.pk,
+                               'offset': upload_session.received}, indent=4)
+
+    return HttpResponse(
+        response_str, content_type='application/json', status=201)
+
+
+@login_required_403
+def upload_session_api_view(request, session_id):
+    """
+    GET: Return the offset up to which the upload has been received, to
+    resume from there.
+
+    PUT: Write the request body at the offset given as query parameter.
+    The SHA-256 of the body has to be sent in the X-Chunk-SHA256 header.
+    Return json formatted reply with the new offset.
+    """
+
+    try:
+        upload_session = UploadSession.objects.get(
+            pk=session_id, employee__user=request.user)
+    except UploadSession.DoesNotExist:
+        return HttpResponse("Upload session could not be found.", status=404)
+
+    if not os.path.exists(upload_session.path):
+        return _upload_file_missing(upload_session)
+
+    if request.method == 'PUT':
+        try:
+            offset = int(request.GET['offset'])
+        except (KeyError, ValueError):
+            return HttpResponse("Invalid offset.", status=400)
+
+        try:
+            upload_session = write_upload_chunk(
+                upload_session, offset, request,
+                request.META.get('HTTP_X_CHUNK_SHA256', ''))
+        except InvalidUploadChunk, e:
+            response_str = json.dumps({'offset': e.offset,
+                                       'error': str(e)}, indent=4)
+            return HttpResponse(
+                response_str, content_type='application/json', status=409)
+    elif request.method != 'GET':
+        return HttpResponse("Please use GET or PUT.", status=405)
+
+    response_str = json.dumps({'session_id': upload_session.pk,
+                               'offset': upload_session.received}, indent=4)
+
+    return HttpResponse(
+        response_str, content_type='application/json', status=200)
+
+
+@login_required_403
+def upload_session_finalize_api_view(request, session_id):
+    """
+    POST: Submit the uploaded file. Replies like submit.
+    """
+
+    if request.method != 'POST':
+        return HttpResponse("Please use POST.", status=405)
+
+    try:
+        upload_session = UploadSession.objects.get(
+            pk=session_id, employee__user=request.user)
+    except UploadSession.DoesNotExist:
+        return HttpResponse("Upload session could not be found.", status=404)
+
+    if not os.path.exists(upload_session.path):
+        return _upload_file_missing(upload_session)
+
+    if upload_session.size is not None \
+            and upload_session.received != upload_session.size:
+        return HttpResponse(
+            "Upload incomplete, received {0} of {1} bytes.".format(
+                upload_session.received, upload_session.size), status=400)
+
+    # The submission consumes a link to the upload, so that the upload is
+    # kept for a retry after other errors than a rejection, e.g. of the
+    # database.
+    submit_path = link_spooled_file(upload_session.path)
+    try:
+        with open(submit_path, 'rb') as fp:
+            response = _submit_to_active_work(
+                upload_session.employee,
+                SpooledFile(fp, name=upload_session.filename),
+                upload_session.comment,
+                upload_session.is_final,
+                upload_session.is_async)
+    finally:
+        if os.path.exists(submit_path):
+            os.remove(submit_path)
+
+    # Submitted or rejected
+    delete_upload_session(upload_session)
+
+    return response
+
+
+@login_required_403
+def submission_status_api_view(request, job_id):
+    """
+    GET: Report whether the checks of an asynchronous submission passed,
+    failed or are still pending. Return json formatted reply.
+    """
+
+    try:
+        job = SubmissionJob.objects.get(pk=job_id, employee__user=request.user)
+    except SubmissionJob.DoesNotExist:
+        return HttpResponse("Submission job could not be found.", status=404)
+
+    response = {
+        'job_id': job.pk,
+        'status': job.status,
+        'message': job.message,
+    }
+
+    response_str = json.dumps(response, indent=4)
+
+    return HttpResponse(
+        response_str, content_type='application/json', status=200)
+
+
 def obsolete_api_view(request):
     return HttpResponse('You are using an incompatible version of Knossos.'
                         'Please upgrade to the newest version.', status=400)
@@ -0,0 +1,92 @@
+"""
+Export of the monthly worktime per employee and task, e.g. for payroll, as
+csv or newline delimited JSON. Used by export_worktime_view and the
+export_worktime command.
+
+The rows are read from the monthly worktime rollup with a server-side cursor
+and formatted as they arrive, so that the memory use does not depend on the
+length of the export.
+"""
+
+import csv
+import json
+from collections import OrderedDict
+
+import models
+from aam_interaction import monthly_worktime_in_range
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson', }
+
+FIELDS = ('year', 'month', 'username', 'first_name', 'last_name', 'project',
+          'category', 'task', 'worktime', 'submissions', 'incomplete_time')
+
+# Rows joined into one chunk of the output
+CHUNK_ROWS = 500
+
+
+def export_rows(start=None, end=None):
+    """
+    Yield a tuple of the values of FIELDS per employee, task and month from
+    start to end, both (year, month) and included. worktime is in hours.
+    """
+
+    worktimes = monthly_worktime_in_range(
+        models.MonthlyWorktime.objects.all(), start, end)
+    rows = worktimes.order_by(
+        'year', 'month', 'employee__user__username', 'task__category__name',
+        'task__name').values_list(
+        'year', 'month', 'employee__user__username',
+        'employee__user__first_name', 'employee__user__last_name',
+        'employee__project__name', 'task__category__name', 'task__name',
+        'worktime', 'submissions', 'untimed_submissions')
+
+    for row in rows.iterator():
+        yield row[:-1] + (row[-1] > 0,)
+
+
+class _Echo(object):
+    # File-like object for csv.writer that hands the line back
+    def write(self, value):
+        return value
+
+
+def _csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        yield writer.writerow([
+            x.encode('utf-8') if isinstance(x, unicode) else x for x in row])
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(OrderedDict(zip(FIELDS, row))) + '\n'
+
+
+def export(fmt, start=None, end=None):
+    """
+    Yield the export as chunks of CHUNK_ROWS lines.
+
+    Parameters
+    ----------
+
+    fmt : str
+        'csv' or 'ndjson'.
+
+    start, end : (int, int) or None
+        First and last month as (year, month), unbounded if None.
+    """
+
+    lines = {'csv': _csv_lines, 'ndjson': _ndjson_lines}[fmt](
+        export_rows(start, end))
+
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
@@ -3,6 +3,7 @@ Functions for interacting with the knossos_aam HTTP API through python. Example
 session shown in main().
 """
 
+import hashlib
 import json
 import os
 import re
@@ -28,6 +29,7 @@ class AAMApi(object):
             # 'session_state': 'api/2/session',
             'session_state': 'api/2/session_json/',
             'submit': 'api/2/submit',
+            'upload_session': 'api/2/upload_session',
             'current_file': 'api/2/current_file',
             'new_task': 'api/2/new_task',
         }
@@ -70,6 +72,67 @@ class AAMApi(object):
         if r.status_code != 201:
             raise AAMError('Submission not successful. {0}'.format(r.content))
 
+    def submit_resumable(self, filename, comment='', is_final=False,
+                         chunk_size=2 ** 20, max_retries=5):
+        """
+        Like submit, but upload the file in chunks of chunk_size bytes. After
+        a failed chunk, the upload is resumed from the offset the server has
+        received, giving up after max_retries consecutive failures.
+        """
+
+        size = os.path.getsize(filename)
+        post_text = {
+            'filename': os.path.basename(filename),
+            'size': size,
+            'submit_comment': comment,
+            'submit_work_is_final': is_final,
+            'csrfmiddlewaretoken': self.session.cookies['csrftoken'], }
+        r = self.session.post(self.urls['upload_session'], post_text)
+        if r.status_code != 201:
+            raise AAMError('Starting upload not successful. {0}'.format(r.content))
+
+        session_url = '{0}/{1}'.format(
+            self.urls['upload_session'], json.loads(r.content)['session_id'])
+        headers = {'X-CSRFToken': self.session.cookies['csrftoken']}
+
+        offset = 0
+        retries = 0
+        with open(filename, 'rb') as fp:
+            while offset < size:
+                fp.seek(offset)
+                chunk = fp.read(chunk_size)
+                headers['X-Chunk-SHA256'] = hashlib.sha256(chunk).hexdigest()
+                try:
+                    r = self.session.put(session_url, data=chunk,
+                                         params={'offset': offset},
+                                         headers=headers)
+                    if r.status_code in (200, 409):
+                        offset = json.loads(r.content)['offset']
+                    if r.status_code == 200:
+                        retries = 0
+                        continue
+                except requests.exceptions.RequestException:
+                    pass
+
+                retries += 1
+                if retries > max_retries:
+                    raise AAMError('Upload not successful after {0} '
+                                   'retries.'.format(max_retries))
+
+                # Resume from what the server actually received
+                try:
+                    r = self.session.get(session_url)
+                    if r.status_code == 200:
+                        offset = json.loads(r.content)['offset']
+                except requests.exceptions.RequestException:
+                    pass
+
+        r = self.session.post(
+            session_url + '/finalize',
+            {'csrfmiddlewaretoken': self.session.cookies['csrftoken']})
+        if r.status_code != 201:
+            raise AAMError('Submission not successful. {0}'.format(r.content))
+
     @staticmethod
     def _get_file_from_response(r):
         """
@@ -81,8 +144,41 @@ class AAMApi(object):
 
         return m.groups()[0], r.content
 
+    @staticmethod
+    def _hash_file(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 2 ** 10), b''):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
     def download_current_file(self, out_dir):
-        r = self.session.get(self.urls['current_file'])
+        """
+        Download the current file to out_dir, unless a file in out_dir has
+        the same contents already. The server's ETag is the SHA-256 of the
+        file, so the files in out_dir are offered by their SHA-256, and a
+        file that was changed locally is downloaded again.
+        """
+
+        local = {}
+        if os.path.isdir(out_dir):
+            for fname in os.listdir(out_dir):
+                path = os.path.join(out_dir, fname)
+                if os.path.isfile(path):
+                    local[self._hash_file(path)] = fname
+
+        headers = {}
+        if local:
+            headers['If-None-Match'] = ', '.join(
+                '"{0}"'.format(x) for x in local)
+        r = self.session.get(self.urls['current_file'], headers=headers)
+        if r.status_code == 304:
+            fname = local.get(r.headers.get('etag', '').strip('"'))
+            if fname is None:
+                raise AAMError('Download not successful, the server did '
+                               'not say which file is current.')
+            return '{0}/{1}'.format(out_dir, fname)
         if r.status_code != 200:
             raise AAMError('Download not successful. {0}'.format(r.content))
 
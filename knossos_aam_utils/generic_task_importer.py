@@ -2,8 +2,22 @@
 Functions for import of tasks into the knossos_aam. Can only be executed on the
 server where the Django knossos_aam application is running.
 
-* todo: Add task category and task name automatically to kzips, to make
-        sure that knossos does not complain anymore.
+The csv is streamed and tasks are created in batches of BATCH_SIZE with
+bulk_create. Model signals are not sent, their normalization of task names
+and paths is done here instead.
+
+Rows with a seed coordinate instead of a task file get a generated k.zip
+with the task category and name, so that knossos does not complain. These
+are built in memory by a pool of processes and written directly to their
+storage location.
+
+import_tasks imports all rows in one transaction. Large imports can use
+resume_import_tasks instead, which commits every batch together with a
+checkpoint and continues after the last checkpoint when run again. Its dry
+run only validates the csv.
+
+* todo: Add task category and task name automatically to the kzips listed
+        in the csv as well.
 
 Example usage from an ipython shell that can import Django:
 
@@ -11,16 +25,341 @@ import generic_task_importer as gti
 
 git.import_tasks(path_to_csv_descriptor, False, False, False, True, 0., '')
 
+gti.resume_import_tasks(path_to_csv_descriptor, dry_run=True)
+gti.resume_import_tasks(path_to_csv_descriptor, False, False, False, True, 0., '')
+
 
 """
 
-from django.core.files import File
+import hashlib
+import os
+import time
+import zipfile
+from collections import namedtuple
+from io import BytesIO
+from multiprocessing import Pool
+from xml.etree import ElementTree
+
+from django.core.files.storage import default_storage
 from django.db import transaction
 from knossos_utils.skeleton_utils import skeleton_from_single_coordinate
 
-from knossos_aam_backend.models import Task, TaskCategory
+from knossos_aam_backend import check_registry
+from knossos_aam_backend import task_dispatcher
+from knossos_aam_backend.helpers import CHUNK_SIZE
+from knossos_aam_backend.helpers import ensure_dir
+from knossos_aam_backend.helpers import hash_file
+from knossos_aam_backend.models import Task, TaskCategory, TaskImport, task_filename
+
+# Tasks created per bulk_create
+BATCH_SIZE = 1000
+
+# Rows whose task files are prepared by a dry run to estimate the throughput
+SAMPLE_SIZE = 100
+
+# Task without task file, whose k.zip is generated from a single seed node
+Seed = namedtuple('Seed', ['coordinate', 'tree_comment'])
+
+
+def read_rows(f, line_number=0):
+    """
+    Yield the line number, the offset after the line and the fields of every
+    non-empty line of the tab separated file object f, without reading it
+    into memory. line_number is the number of the line before the current
+    position of f.
+    """
+
+    # readline instead of iterating over f, which reads ahead and breaks tell
+    for cur_line in iter(f.readline, ''):
+        line_number += 1
+        cur_task = [x for x in cur_line.split('\t') if not x.isspace()]
+        cur_task = [x.strip() for x in cur_task if x != '']
+
+        # fix problems with empty lines at end etc
+        if len(cur_task) == 0:
+            continue
+
+        yield line_number, f.tell(), cur_task
+
+
+def parse_row(cur_task):
+    """
+    Returns
+    -------
+
+    category : str
+
+    task_id : str
+
+    source : str or Seed
+        The path of the task file, or the seed to generate it from.
+
+    target_coverage : int
+    """
+
+    if len(cur_task) == 4:
+        category = cur_task[0]
+        task_id = cur_task[1]
+        source = cur_task[2]
+        target_coverage = int(cur_task[3])
+
+        if not os.path.isfile(source):
+            raise Exception(
+                'Task path in csv file could not be matched to an '
+                'actual task file: ' + source)
+    elif len(cur_task) in (6, 7):
+        category = cur_task[0]
+        task_id = cur_task[1]
+        x = int(cur_task[2])
+        y = int(cur_task[3])
+        z = int(cur_task[4])
+        target_coverage = int(cur_task[5])
+        tree_comment = cur_task[6].strip() if len(cur_task) == 7 else None
+
+        source = Seed((x, y, z), tree_comment)
+    else:
+        raise Exception('Unknown format.')
+
+    return category, task_id, source, target_coverage
+
+
+def seed_kzip(category, name, seed):
+    """
+    Returns
+    -------
+
+    data : str
+        A k.zip with a single node at the coordinate of Seed seed, tagged
+        with the task category and name.
+    """
+
+    s = skeleton_from_single_coordinate(
+        list(seed.coordinate), comment='First Node', branchpoint=True)
+    if seed.tree_comment is not None:
+        for cur_a in s.getAnnotations():
+            cur_a.comment = seed.tree_comment
+
+    root = ElementTree.fromstring(s.to_xml_string())
+    parameters = root.find('parameters')
+    if parameters is None:
+        parameters = ElementTree.SubElement(root, 'parameters')
+    ElementTree.SubElement(parameters, 'task', category=category, name=name)
+
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zipper:
+        zipper.writestr('annotation.xml',
+                        ElementTree.tostring(root, encoding='UTF-8'))
+
+    return buf.getvalue()
+
+
+def write_seed_kzip(args):
+    """
+    Write the k.zip of a seed to path, run in the processes of the pool.
+
+    Returns
+    -------
+
+    sha256 : str
+    """
+
+    path, category, name, seed = args
+    data = seed_kzip(category, name, seed)
+    with open(path, 'wb') as fp:
+        fp.write(data)
+
+    return hashlib.sha256(data).hexdigest()
+
+
+class CategoryCache(object):
+    """
+    Resolves category names to TaskCategory instances, querying each name
+    only once.
+    """
+
+    def __init__(self):
+        self.categories = {}
+
+    def get(self, name):
+        if name not in self.categories:
+            self.categories[name] = TaskCategory.objects.select_related(
+                'project').get(name=name)
+
+        return self.categories[name]
+
+
+def normalize_task(t):
+    """
+    Apply the normalization of the Task pre_save signals, which bulk_create
+    does not send.
+    """
+
+    t.name = t.name.replace('-', '_')
+    t.category_name_combination = '{0}_{1}'.format(t.category.name, t.name)
+
+
+def task_file_path(t, filename, created_dirs):
+    """
+    Set the task file name of Task t to a free storage name for filename.
+
+    created_dirs : set
+        Directories known to exist, shared between calls.
+
+    Returns
+    -------
+
+    path : str
+        Absolute path of the task file.
+    """
+
+    t.task_file.name = default_storage.get_available_name(
+        task_filename(t, filename))
+    path = default_storage.path(t.task_file.name)
+
+    dir_name = os.path.dirname(path)
+    if dir_name not in created_dirs:
+        ensure_dir(dir_name)
+        created_dirs.add(dir_name)
+
+    return path
+
+
+def store_task_file(t, task_filepath, created_dirs):
+    """
+    Copy the file at task_filepath to the storage location of the task file
+    of Task t, hashing it on the way.
+    """
+
+    path = task_file_path(t, os.path.basename(task_filepath), created_dirs)
+
+    sha256 = hashlib.sha256()
+    with open(task_filepath, 'rb') as in_fp, open(path, 'wb') as out_fp:
+        for chunk in iter(lambda: in_fp.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            out_fp.write(chunk)
 
-AUTO_GENERATED_NML_DIR = 'auto_generated_nml'
+    t.task_file_sha256 = sha256.hexdigest()
+
+
+def create_tasks(tasks, created_dirs, pool):
+    """
+    Store the task files of tasks, a list of (Task, task file path or Seed),
+    and create the tasks with one bulk_create. The k.zips of seeds are
+    generated by the processes of pool.
+    """
+
+    seeds = []
+    try:
+        for t, source in tasks:
+            if isinstance(source, Seed):
+                path = task_file_path(t, '{0}.k.zip'.format(t.name), created_dirs)
+                seeds.append((t, (path, t.category.name, t.name, source)))
+            else:
+                store_task_file(t, source, created_dirs)
+
+        if seeds:
+            hashes = pool.map(write_seed_kzip, [x[1] for x in seeds])
+            for (t, _), sha256 in zip(seeds, hashes):
+                t.task_file_sha256 = sha256
+
+        Task.objects.bulk_create([x[0] for x in tasks])
+    except:
+        # Do not leave the files of tasks that were not created behind
+        for t, _ in tasks:
+            if t.task_file.name and os.path.isfile(t.task_file.path):
+                os.remove(t.task_file.path)
+        raise
+
+
+def skip_existing(tasks):
+    """
+    Returns
+    -------
+
+    tasks : list of (Task, str or Seed)
+        tasks without the tasks that already exist or are duplicates.
+
+    skipped : int
+    """
+
+    existing = set(Task.objects.filter(category_name_combination__in=[
+        x[0].category_name_combination for x in tasks]).values_list(
+        'category_name_combination', flat=True))
+
+    new_tasks = []
+    for t, source in tasks:
+        if t.category_name_combination not in existing:
+            existing.add(t.category_name_combination)
+            new_tasks.append((t, source))
+
+    return new_tasks, len(tasks) - len(new_tasks)
+
+
+def task_checks(
+        check_simple,
+        check_seed_contained,
+        check_connected_component,
+        automatic_worktime):
+    checks = []
+    if check_simple:
+        checks.append('check_simple')
+    if check_connected_component:
+        checks.append('check_connected_component')
+    if check_seed_contained:
+        checks.append('check_seed_contained')
+    if automatic_worktime:
+        checks.append('automatic_worktime')
+
+    # Validated once here, instead of by the post_save signal of every Task
+    available_checks = check_registry.get_check_fns()
+    for cur_check in checks:
+        if cur_check not in available_checks:
+            raise Exception('Check {0} is not available. Please try again.'.format(cur_check))
+
+    return ' '.join(checks)
+
+
+def task_batches(f, checks, comment, freeze_delay, batch_size, line_number=0):
+    """
+    Yield lists of at most batch_size (Task, task file path or Seed) for the
+    rows of the csv file object f, with the line number and offset after the
+    last row of the list.
+    """
+
+    categories = CategoryCache()
+    batch = []
+    offset = f.tell()
+
+    for line_number, offset, cur_task in read_rows(f, line_number):
+        try:
+            category, task_id, source, target_coverage = \
+                parse_row(cur_task)
+            category = categories.get(category)
+        except Exception, e:
+            raise Exception('Line {0}: {1}'.format(line_number, e))
+
+        t = Task(name=str(task_id),
+                 target_coverage=target_coverage,
+                 category=category,
+                 checks=checks,
+                 comment=comment,
+                 freeze_delay=freeze_delay)
+        normalize_task(t)
+        batch.append((t, source))
+
+        if len(batch) >= batch_size:
+            yield batch, line_number, offset
+            batch = []
+
+    if batch:
+        yield batch, line_number, offset
+
+
+def invalidate_dispatcher():
+    # bulk_create sends no signals to the task dispatcher
+    dispatcher = task_dispatcher.get_dispatcher()
+    if dispatcher is not None:
+        dispatcher.invalidate()
 
 
 @transaction.atomic
@@ -31,96 +370,169 @@ def import_tasks(
         check_connected_component=True,
         automatic_worktime=True,
         freeze_delay=0.,
-        comment=''):
+        comment='',
+        processes=None):
     """
     Script to create new tasks in amm that are  kzip based task files
     that can be downloaded.
+
+    processes : int or None
+        Number of processes generating seed k.zips, all cores if None.
     """
 
-    with open(csv_input, 'r') as f:
-        for cur_line in f.readlines():
-            cur_task = [x for x in cur_line.split('\t') if not x.isspace()]
-            cur_task = [x.strip() for x in cur_task if x != '']
-            print('Importing: {0}'.format(cur_task))
+    checks = task_checks(check_simple, check_seed_contained,
+                         check_connected_component, automatic_worktime)
+
+    created_dirs = set()
+    count = 0
+    start = time.time()
+
+    # Forked before the tasks are created, the processes only write files
+    pool = Pool(processes)
+    try:
+        with open(csv_input, 'r') as f:
+            for batch, line_number, _ in task_batches(
+                    f, checks, comment, freeze_delay, BATCH_SIZE):
+                create_tasks(batch, created_dirs, pool)
+                count += len(batch)
+                print('Imported {0} tasks, up to line {1} ({2:.0f} rows/s)'.format(
+                    count, line_number, count / max(time.time() - start, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
 
-            # fix problems with empty lines at end etc
-            if len(cur_task) == 0:
+    invalidate_dispatcher()
+
+
+def validate_import(csv_input, sample_size=SAMPLE_SIZE):
+    """
+    Dry run of an import. Checks every row of csv_input, the task files and
+    the categories it references, without creating anything, and estimates
+    the import throughput from preparing the task files of the first
+    sample_size rows.
+
+    Returns
+    -------
+
+    errors : list of str
+    """
+
+    errors = []
+    categories = {}
+    sample = []
+    count = 0
+    start = time.time()
+
+    with open(csv_input, 'r') as f:
+        for line_number, _, cur_task in read_rows(f):
+            try:
+                category, task_id, source, _ = parse_row(cur_task)
+            except Exception, e:
+                errors.append('Line {0}: {1}'.format(line_number, e))
                 continue
 
-            if len(cur_task) == 4:
-                category = cur_task[0]
-                task_id = cur_task[1]
-                task_filepath = cur_task[2]
-                target_coverage = int(cur_task[3])
-            elif len(cur_task) == 6:
-                category = cur_task[0]
-                task_id = cur_task[1]
-                x = int(cur_task[2])
-                y = int(cur_task[3])
-                z = int(cur_task[4])
-                target_coverage = int(cur_task[5])
-
-                s = skeleton_from_single_coordinate(
-                    [x, y, z], comment='First Node', branchpoint=True)
-                task_filepath = '{0}/{1}_{2}.nml'.format(
-                    AUTO_GENERATED_NML_DIR,
-                    category,
-                    task_id,)
-                s.toNml(task_filepath)
-            elif len(cur_task) == 7:
-                category = cur_task[0]
-                task_id = cur_task[1]
-                x = int(cur_task[2])
-                y = int(cur_task[3])
-                z = int(cur_task[4])
-                target_coverage = int(cur_task[5])
-                tree_comment = cur_task[6].strip()
-
-                s = skeleton_from_single_coordinate([x, y, z], comment='First Node', branchpoint=True)
-                for cur_a in s.getAnnotations():
-                    cur_a.comment = tree_comment
-                task_filepath = '{0}/{1}_{2}.nml'.format(
-                    AUTO_GENERATED_NML_DIR,
-                    category,
-                    task_id,)
-                s.toNml(task_filepath)
+            categories.setdefault(category, line_number)
+            count += 1
+            if len(sample) < sample_size:
+                sample.append((category, str(task_id).replace('-', '_'), source))
+
+    known = set(TaskCategory.objects.filter(
+        name__in=categories.keys()).values_list('name', flat=True))
+    for category, line_number in sorted(categories.items(), key=lambda x: x[1]):
+        if category not in known:
+            errors.append('Line {0}: unknown category {1}'.format(
+                line_number, category))
+
+    print('Validated {0} rows ({1:.0f} rows/s), {2} errors'.format(
+        count, count / max(time.time() - start, 1e-6), len(errors)))
 
+    if sample:
+        start = time.time()
+        for category, name, source in sample:
+            if isinstance(source, Seed):
+                seed_kzip(category, name, source)
             else:
-                raise Exception('Unknown format.')
+                hash_file(source)
+        rate = len(sample) / max(time.time() - start, 1e-6)
+        print('Estimated import throughput {0:.0f} rows/s per process, '
+              '{1:.0f} s for {2} rows'.format(rate, count / rate, count))
 
-            try:
-                with open(task_filepath):
-                    pass
-            except IOError:
-                raise Exception(
-                    'Task path in csv file could not be matched to an '
-                    'actual task file: ' + task_filepath)
-
-            cat = TaskCategory.objects.get(name=category)
-            taskfileobj = file(task_filepath)
-
-            checks = []
-            if check_simple:
-                checks.append('check_simple')
-            if check_connected_component:
-                checks.append('check_connected_component')
-            if check_seed_contained:
-                checks.append('check_seed_contained')
-            if automatic_worktime:
-                checks.append('automatic_worktime')
-
-            checks = ' '.join(checks)
-
-            t = Task.objects.create(name=str(task_id),
-                                    target_coverage=target_coverage,
-                                    category=cat,
-                                    checks=checks,
-                                    comment=comment,
-                                    freeze_delay=freeze_delay,
-                                    task_file=File(taskfileobj))
-
-            t.save()
-            taskfileobj.close()
+    return errors
+
+
+def resume_import_tasks(
+        csv_input,
+        check_simple=True,
+        check_seed_contained=True,
+        check_connected_component=True,
+        automatic_worktime=True,
+        freeze_delay=0.,
+        comment='',
+        processes=None,
+        batch_size=BATCH_SIZE,
+        dry_run=False):
+    """
+    Import the tasks of csv_input like import_tasks, but commit every batch
+    of batch_size rows together with a TaskImport checkpoint. Run again
+    after a failure, it continues after the last committed batch and skips
+    tasks that already exist.
+
+    dry_run : bool
+        Only validate csv_input, see validate_import.
+
+    Returns
+    -------
+
+    checkpoint : TaskImport instance, or list of str errors for a dry run
+    """
+
+    if dry_run:
+        return validate_import(csv_input)
+
+    checks = task_checks(check_simple, check_seed_contained,
+                         check_connected_component, automatic_worktime)
+
+    checkpoint, _ = TaskImport.objects.get_or_create(
+        csv_input=os.path.abspath(csv_input))
+    if checkpoint.finished:
+        print('Already imported: {0}'.format(checkpoint))
+        return checkpoint
+
+    created_dirs = set()
+    count = 0
+    start = time.time()
+
+    pool = Pool(processes)
+    try:
+        with open(csv_input, 'r') as f:
+            f.seek(checkpoint.offset)
+            for batch, line_number, offset in task_batches(
+                    f, checks, comment, freeze_delay, batch_size,
+                    checkpoint.line_number):
+                with transaction.atomic():
+                    batch, skipped = skip_existing(batch)
+                    create_tasks(batch, created_dirs, pool)
+
+                    checkpoint.offset = offset
+                    checkpoint.line_number = line_number
+                    checkpoint.imported += len(batch)
+                    checkpoint.skipped += skipped
+                    checkpoint.save()
+
+                count += len(batch)
+                print('Imported {0} tasks, up to line {1} ({2:.0f} rows/s)'.format(
+                    checkpoint.imported, line_number,
+                    count / max(time.time() - start, 1e-6)))
+    finally:
+        pool.close()
+        pool.join()
+        invalidate_dispatcher()
+
+    checkpoint.finished = True
+    checkpoint.save()
+    print('Finished {0}'.format(checkpoint))
+
+    return checkpoint
 
 
 # settings hints:
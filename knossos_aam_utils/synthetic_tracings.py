@@ -0,0 +1,86 @@
+"""
+Generator for synthetic tracings, e.g. for benchmarking submissions. The nml
+is written line by line, so tracings of millions of nodes can be generated
+without holding them in memory.
+
+Example usage:
+
+import synthetic_tracings as st
+
+st.write_synthetic_kzip('example.k.zip', 100000, trees=4)
+"""
+
+import os
+import random
+import tempfile
+from zipfile import ZIP_DEFLATED, ZipFile
+
+NML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<things>
+    <parameters>
+        <experiment name="synthetic"/>
+        <lastsavedin version="{version}"/>
+        <createdin version="{version}"/>
+        <time ms="{time_ms}" checksum=""/>
+        <idleTime ms="{idle_time_ms}" checksum=""/>
+        <scale x="1" y="1" z="1"/>
+    </parameters>
+"""
+
+NML_FOOTER = """    <comments/>
+    <branchpoints/>
+</things>
+"""
+
+
+def write_synthetic_nml(fp, nodes, trees=1, time_ms=3600000, idle_time_ms=0,
+                        version='4.1.2', seed=0):
+    """
+    Write an nml with nodes nodes, split into trees trees. Each tree is a
+    random walk, i.e. a chain of connected nodes.
+    """
+
+    rnd = random.Random(seed)
+    fp.write(NML_HEADER.format(version=version, time_ms=time_ms,
+                               idle_time_ms=idle_time_ms))
+
+    node_id = 1
+    for tree_id in range(1, trees + 1):
+        tree_nodes = nodes // trees + (1 if tree_id <= nodes % trees else 0)
+        first_id = node_id
+        x, y, z = rnd.randint(0, 10000), rnd.randint(0, 10000), rnd.randint(0, 10000)
+
+        fp.write('    <thing id="{0}">\n        <nodes>\n'.format(tree_id))
+        for _ in range(tree_nodes):
+            x += rnd.randint(-5, 5)
+            y += rnd.randint(-5, 5)
+            z += rnd.randint(-2, 2)
+            fp.write('            <node id="{0}" radius="1.5" x="{1}" y="{2}" '
+                     'z="{3}" inVp="0" inMag="1" time="0"/>\n'.format(
+                         node_id, x, y, z))
+            node_id += 1
+        fp.write('        </nodes>\n        <edges>\n')
+        for source in range(first_id, node_id - 1):
+            fp.write('            <edge source="{0}" target="{1}"/>\n'.format(
+                source, source + 1))
+        fp.write('        </edges>\n    </thing>\n')
+
+    fp.write(NML_FOOTER)
+
+
+def write_synthetic_kzip(path, nodes, trees=1, **kwargs):
+    """
+    Write a k.zip containing a synthetic annotation.xml to path. kwargs are
+    passed to write_synthetic_nml.
+    """
+
+    fd, nml_path = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            write_synthetic_nml(fp, nodes, trees, **kwargs)
+        with ZipFile(path, 'w', ZIP_DEFLATED) as zipper:
+            zipper.write(nml_path, 'annotation.xml')
+    finally:
+        os.remove(nml_path)
+
+    return path